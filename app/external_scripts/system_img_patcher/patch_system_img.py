@@ -9,6 +9,11 @@ import logging
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# Worker processes for the smali patches, set with --workers.
+PATCH_WORKERS = 1
+# Directory for the parsed smali cache kept between runs, set with --cache.
+PATCH_CACHE_DIR = None
+
 def exit_now(err_code):
     if err_code != 0:
         logging.error(f"Exiting with error code: {err_code}")
@@ -30,15 +35,84 @@ class MountImage:
         run_command(f'umount {self.mount_point}')
         logging.info(f"Unmounted {self.image_path} from {self.mount_point}")
 
-keep_scale_count = 0
+OVERRIDE_ANIMATOR_SCALE = SmaliTemplate([
+    'const {scale}, 0x3f800000',
+    'invoke-virtual {{{animator}, {scale}}}, {animator_class}->overrideDurationScale(F)V',
+])
+
+def get_smali_for_property_set(property_name, property_value):
+    # Template lines, with the registers left to key_register and value_register.
+    return [
+        f'const-string {{key_register}}, "{property_name}"',
+        f'const-string {{value_register}}, "{property_value}"',
+        'invoke-static {{{key_register}, {value_register}}}, Landroid/os/SystemProperties;->set(Ljava/lang/String;Ljava/lang/String;)V',
+    ]
+
+START_VIBRATION_LOCKED = SmaliTemplate([
+    'iget-object v0, p1, {base_dir}/Vibration;->callerInfo:{base_dir}/Vibration$CallerInfo;',
+    'iget-object v0, v0, {base_dir}/Vibration$CallerInfo;->attrs:Landroid/os/VibrationAttributes;',
+    'invoke-virtual {{v0}}, Landroid/os/VibrationAttributes;->getUsage()I',
+    'move-result v0',
+    'const/16 v1, 0x0',
+    'if-eq v0, v1, :usage_unknown',
+    'const/16 v1, 0x11',
+    'if-eq v0, v1, :usage_alarm',
+    'const/16 v1, 0x21',
+    'if-eq v0, v1, :usage_ringtone',
+    'const/16 v1, 0x31',
+    'if-eq v0, v1, :usage_notification',
+    'const/16 v1, 0x41',
+    'if-eq v0, v1, :usage_communication_request',
+    'const/16 v1, 0x12',
+    'if-eq v0, v1, :usage_touch',
+    'const/16 v1, 0x22',
+    'if-eq v0, v1, :usage_physical_emulation',
+    'const/16 v1, 0x32',
+    'if-eq v0, v1, :usage_hardware_feedback',
+    'const/16 v1, 0x42',
+    'if-eq v0, v1, :usage_accessibility',
+    ':usage_unknown',
+    ':usage_alarm',
+    ':usage_ringtone',
+    ':usage_communication_request',
+    ':try_start_ring',
+] + get_smali_for_property_set('sys.linevibrator_on', '1') + [
+    ':try_end_ring',
+    '.catchall {{:try_start_ring .. :try_end_ring}} :catch_all_usage',
+    ':usage_notification',
+    ':try_start_notif',
+] + get_smali_for_property_set('sys.linevibrator_on', '1') + [
+    ':try_end_notif',
+    '.catchall {{:try_start_notif .. :try_end_notif}} :catch_all_usage',
+    'goto :usage_end',
+    ':usage_touch',
+    ':usage_physical_emulation',
+    ':usage_hardware_feedback',
+    ':usage_accessibility',
+    ':try_start_touch',
+] + get_smali_for_property_set('sys.linevibrator_on', '2') + [
+    ':try_end_touch',
+    '.catchall {{:try_start_touch .. :try_end_touch}} :catch_all_usage',
+    'goto :usage_end',
+    ':catch_all_usage',
+    'move-exception v0',
+    'const-string v1, "Vibration Error"',
+    'const-string v2, "Exception while writing to file"',
+    'invoke-static {{v1, v2, v0}}, Landroid/util/Log;->e(Ljava/lang/String;Ljava/lang/String;Ljava/lang/Throwable;)I',
+    ':usage_end',
+    'invoke{invoke_modifier} {{p0, p1}}, {class_name}->{method_name}({parameters}){return_type}',
+    'move-result-object v0',
+    'return-object v0',
+])
+
 def patch_OverrideAnimatorScale(instruction):
-    global keep_scale_count
     registers = instruction.get_n_free_registers(1)
-    instruction.expand_before([
-        f'const {registers[0]}, 0x3f800000',
-        f'invoke-virtual {{{instruction.registers[0]}, {registers[0]}}}, {instruction.class_name}->overrideDurationScale(F)V',
-    ])
-    keep_scale_count += 1
+    instruction.expand_before(OVERRIDE_ANIMATOR_SCALE.instantiate(
+        instruction.parent,
+        scale = registers[0],
+        animator = instruction.registers[0],
+        animator_class = instruction.class_name,
+    ))
 
 def patch_services_jar():
     def add_pattern_to_initrc(property_name, property_value, pattern_seq, pattern_loop, do_open=False):
@@ -59,12 +133,6 @@ def patch_services_jar():
             if do_open:
                 init_file.write('write /sys/class/leds/vibrator/reg "0x13 0x0f"\n')
 
-    def get_smali_for_property_set(register1, register2, property_name, property_value):
-            return [
-                f'const-string {register1}, "{property_name}"',
-                f'const-string {register2}, "{property_value}"',
-                f'invoke-static {{{register1}, {register2}}}, Landroid/os/SystemProperties;->set(Ljava/lang/String;Ljava/lang/String;)V',
-            ]
 
     invokeVibrationLocked = None
     def extract_invokeVibrationLocked(instruction):
@@ -92,65 +160,20 @@ def patch_services_jar():
         )
         new_method = SmaliMethod(method.header, method.parent)
         new_method.name = "tempStartVibrationLocked"
-        method.parent.items.append(('method', new_method))
+        method.parent.add_method(new_method)
         method.name = "originalStartVibrationLocked"
         new_method.add_instruction('.locals 5')
-        for instruction in [
-            f'iget-object v0, p1, {method.parent.base_dir}/Vibration;->callerInfo:{method.parent.base_dir}/Vibration$CallerInfo;',
-            f'iget-object v0, v0, {method.parent.base_dir}/Vibration$CallerInfo;->attrs:Landroid/os/VibrationAttributes;',
-            'invoke-virtual {v0}, Landroid/os/VibrationAttributes;->getUsage()I',
-            'move-result v0',
-            'const/16 v1, 0x0',
-            'if-eq v0, v1, :usage_unknown',
-            'const/16 v1, 0x11',
-            'if-eq v0, v1, :usage_alarm',
-            'const/16 v1, 0x21',
-            'if-eq v0, v1, :usage_ringtone',
-            'const/16 v1, 0x31',
-            'if-eq v0, v1, :usage_notification',
-            'const/16 v1, 0x41',
-            'if-eq v0, v1, :usage_communication_request',
-            'const/16 v1, 0x12',
-            'if-eq v0, v1, :usage_touch',
-            'const/16 v1, 0x22',
-            'if-eq v0, v1, :usage_physical_emulation',
-            'const/16 v1, 0x32',
-            'if-eq v0, v1, :usage_hardware_feedback',
-            'const/16 v1, 0x42',
-            'if-eq v0, v1, :usage_accessibility',
-            ':usage_unknown',
-            ':usage_alarm',
-            ':usage_ringtone',
-            ':usage_communication_request',
-            ':try_start_ring',
-        ] + get_smali_for_property_set('v0', 'v1', 'sys.linevibrator_on', '1') + [
-            ':try_end_ring',
-            '.catchall {:try_start_ring .. :try_end_ring} :catch_all_usage',
-            ':usage_notification',
-            ':try_start_notif',
-        ] + get_smali_for_property_set('v0', 'v1', 'sys.linevibrator_on', '1') + [
-            ':try_end_notif',
-            '.catchall {:try_start_notif .. :try_end_notif} :catch_all_usage',
-            'goto :usage_end',
-            ':usage_touch',
-            ':usage_physical_emulation',
-            ':usage_hardware_feedback',
-            ':usage_accessibility',
-            ':try_start_touch',
-        ] + get_smali_for_property_set('v0', 'v1', 'sys.linevibrator_on', '2') + [
-            ':try_end_touch',
-            '.catchall {:try_start_touch .. :try_end_touch} :catch_all_usage',
-            'goto :usage_end',
-            ':catch_all_usage',
-            'move-exception v0',
-            'const-string v1, "Vibration Error"',
-            'const-string v2, "Exception while writing to file"',
-            'invoke-static {v1, v2, v0}, Landroid/util/Log;->e(Ljava/lang/String;Ljava/lang/String;Ljava/lang/Throwable;)I',
-            ':usage_end',
-            f'invoke{invokeVibrationLocked.modifier} {{p0, p1}}, {method.parent.class_name}->{method.name}({method.parameters}){method.return_type}',
-            'move-result-object v0',
-            'return-object v0',
-        ]:
+        for instruction in START_VIBRATION_LOCKED.instantiate(
+            new_method,
+            key_register = 'v0',
+            value_register = 'v1',
+            base_dir = method.parent.base_dir,
+            invoke_modifier = invokeVibrationLocked.modifier,
+            class_name = method.parent.class_name,
+            method_name = method.name,
+            parameters = method.parameters,
+            return_type = method.return_type,
+        ):
             new_method.add_instruction(instruction)
 
 
@@ -266,8 +289,7 @@ def patch_services_jar():
 
     def patch_ColorDisplayServiceInternal(smali_file):
         base_class = smali_file.smali_class.class_name.split('$')[0]
-        smali_file.smali_class.items.append((
-            'method',
+        smali_file.smali_class.add_method(
             SmaliMethod(
                 '.method public getColorTemperature()F',
                 smali_file.smali_class,
@@ -294,7 +316,7 @@ def patch_services_jar():
                     'return v0',
                 ]
             )
-        ))
+        )
     ev_pattern = re.compile(r"[^{]{([^}{]*)}[^}]")
     def format_eval(string, **kwargs):
         all_matches = ev_pattern.findall(string)
@@ -323,6 +345,12 @@ def patch_services_jar():
 
         return None
 
+    shader_entry_template = SmaliTemplate([
+        'const-string {string_register}, "{shader}"',
+        'const {index_register}, {index}',
+        'aput-object {string_register}, {array_register}, {index_register}',
+    ])
+
     def patch_ColorFadeInit(method):
         registers = method.first_instruction.next.get_n_free_registers(3)
         static_shader_list_smali = [
@@ -330,12 +358,14 @@ def patch_services_jar():
            f"new-array {registers[1]}, {registers[0]}, [Ljava/lang/String;",
         ]
         for i, shader in enumerate(shaders):
-            escaped_shader = "\"" + repr(shader)[1:-1] + "\""
-            static_shader_list_smali.extend([
-                f"const-string {registers[0]}, {escaped_shader}",
-                f"const {registers[2]}, {hex(i)}",
-                f"aput-object {registers[0]}, {registers[1]}, {registers[2]}",
-            ])
+            static_shader_list_smali.extend(shader_entry_template.instantiate(
+                method,
+                string_register = registers[0],
+                array_register = registers[1],
+                index_register = registers[2],
+                shader = repr(shader)[1:-1],
+                index = hex(i),
+            ))
         static_shader_list_smali.append(f"sput-object {registers[1]}, {method.parent.class_name}->SHADER_LIST:[Ljava/lang/String;")
         method.first_instruction.expand_after(static_shader_list_smali)
 
@@ -393,14 +423,13 @@ def patch_services_jar():
         smali_class = smali_file.smali_class
         smali_class.add_field(".field private static final SHADER_LIST:[Ljava/lang/String;")
         if not smali_class.has_method(method = MethodDetails(name="<clinit>")):
-            smali_class.items.append((
-                'method',
+            smali_class.add_method(
                 SmaliMethod(
                     '.method static constructor <clinit>()V',
                     smali_class,
                     ['.locals 3', 'return-void'],
                 )
-            ))
+            )
         smali_class.for_method(
             method = MethodDetails(name = "<clinit>", return_type = "V"),
             action = patch_ColorFadeInit,
@@ -410,11 +439,9 @@ def patch_services_jar():
             action = patch_readFile,
         )
 
-    def patch_GetBrightness(instruction):
-        value = "0x0" if "Adjustment" in instruction.method else "0x3f800000"
-        instruction = instruction.next_known()
-        if instruction.instruction_type != InstructionType.MOVE_RESULT:
-            return
+    def patch_GetBrightness(match):
+        invoke, instruction = match
+        value = "0x0" if "Adjustment" in invoke.method else "0x3f800000"
         register = instruction.next.get_n_free_registers(1)[0]
         instruction.expand_after([
             f"const {register}, {value}",
@@ -468,8 +495,7 @@ def patch_services_jar():
             'return v0',
             ':dont_skip',
         ])
-        method.parent.items.append((
-                    'method',
+        method.parent.add_method(
                     SmaliMethod(
                         '.method private handleWakeUpOnVolume(Landroid/view/KeyEvent;)Z',
                         method.parent,
@@ -533,10 +559,9 @@ def patch_services_jar():
                             'return v0',
                         ]
                     )
-                ))
+                )
 
-        method.parent.items.append((
-            'method',
+        method.parent.add_method(
             SmaliMethod(
                 '.method private handleVolumeKeyEventUp(Landroid/view/KeyEvent;)Z',
                 method.parent,
@@ -587,10 +612,9 @@ def patch_services_jar():
                     'return v0',
                 ]
             )
-        ))
+        )
 
-        method.parent.items.append((
-                    'method',
+        method.parent.add_method(
                     SmaliMethod(
                         '.method private handleVolumeKeyEventDown(Landroid/view/KeyEvent;)Z',
                         method.parent,
@@ -656,10 +680,9 @@ def patch_services_jar():
                             'return v0',
                         ]
                     )
-                ))
+                )
 
-        method.parent.items.append((
-            'method',
+        method.parent.add_method(
             SmaliMethod(
                 '.method public forceHideKeyguard()V',
                 method.parent,
@@ -674,10 +697,9 @@ def patch_services_jar():
                     'return-void',
                 ]
             )
-        ))
+        )
 
-        method.parent.items.append((
-            'method',
+        method.parent.add_method(
             SmaliMethod(
                 '.method public sendPastKeyUpEvent()V',
                 method.parent,
@@ -695,10 +717,9 @@ def patch_services_jar():
                     'return-void',
                 ]
             )
-        ))
+        )
 
-        method.parent.items.append((
-            'method',
+        method.parent.add_method(
             SmaliMethod(
                 '.method public sendPastKeyDownEvent()V',
                 method.parent,
@@ -716,10 +737,9 @@ def patch_services_jar():
                     'return-void',
                 ]
             )
-        ))
+        )
 
-        method.parent.items.append((
-            'method',
+        method.parent.add_method(
             SmaliMethod(
                 '.method public flipMaxBrightness(I)V',
                 method.parent,
@@ -747,7 +767,7 @@ def patch_services_jar():
                     'return-void',
                 ]
             )
-        ))
+        )
 
     def patch_phoneWindowManagerInit(instruction):
         registers = instruction.next.get_n_free_registers(2)
@@ -762,62 +782,68 @@ def patch_services_jar():
             f'iput-object {registers[0]}, {instruction.registers[1]}, {instruction.parent.parent.class_name}->mLastUpKeyEvent:Landroid/view/KeyEvent;',
         ])
 
+    window_manager_handler_template = SmaliTemplate([
+        'iget v0, p1, Landroid/os/Message;->what:I',
+        f'const v1, {hex(595)}',
+        'if-eq v0, v1, :handle_go_to_sleep',
+        f'const v1, {hex(596)}',
+        'if-eq v0, v1, :handle_fix_backlight',
+        f'const v1, {hex(600)}',
+        'if-eq v0, v1, :handle_down',
+        f'const v1, {hex(601)}',
+        'if-eq v0, v1, :handle_up',
+        'goto :handle_other_messages',
+
+        ':handle_down',
+        'iget-object v0, p0, {handler_class}->this$0:{manager_class};',
+        'invoke-virtual {{v0}}, {manager_class};->sendPastKeyDownEvent()V',
+        'return-void',
+
+        ':handle_up',
+        'iget-object v0, p0, {handler_class}->this$0:{manager_class};',
+        'invoke-virtual {{v0}}, {manager_class};->sendPastKeyUpEvent()V',
+        'return-void',
+
+        ':handle_fix_backlight',
+        'const-string v2, "sys.linevibrator_touch"',
+        'invoke-static {{v2}}, Landroid/os/SystemProperties;->get(Ljava/lang/String;)Ljava/lang/String;',
+        'move-result-object v0',
+        ':try_number_type_start',
+        'invoke-static {{v0}}, Ljava/lang/Integer;->parseInt(Ljava/lang/String;)I',
+        'move-result v0',
+        ':try_number_type_end',
+        '.catchall {{:try_number_type_start .. :try_number_type_end}} :skip_flipping',
+        'if-gez v0, :skip_flipping',
+        'const v1, 0x0',
+        'sub-int v0, v1, v0',
+        'new-instance v1, Ljava/lang/StringBuilder;',
+        'invoke-direct {{v1}}, Ljava/lang/StringBuilder;-><init>()V',
+        'invoke-virtual {{v1, v0}}, Ljava/lang/StringBuilder;->append(I)Ljava/lang/StringBuilder;',
+        'invoke-virtual {{v1}}, Ljava/lang/StringBuilder;->toString()Ljava/lang/String;',
+        'move-result-object v1',
+        'invoke-static {{v2, v1}}, Landroid/os/SystemProperties;->set(Ljava/lang/String;Ljava/lang/String;)V',
+        ':skip_flipping',
+        'return-void',
+
+        ':handle_go_to_sleep',
+        'iget-object v0, p0, {handler_class}->this$0:{manager_class};',
+        'iget-object v1, v0, {manager_class};->mPowerManager:Landroid/os/PowerManager;',
+        'invoke-static {{}}, Landroid/os/SystemClock;->uptimeMillis()J',
+        'move-result-wide v2',
+        'invoke-virtual {{v1, v2, v3}}, Landroid/os/PowerManager;->goToSleep(J)V',
+        'invoke-virtual {{v0}}, {manager_class};->forceHideKeyguard()V',
+        'return-void',
+
+        ':handle_other_messages',
+    ])
+
     def patch_windowManagerHandler(method):
         method.first_instruction.get_n_free_registers(4)
-        method.first_instruction.expand_after([
-            'iget v0, p1, Landroid/os/Message;->what:I',
-            f'const v1, {hex(595)}',
-            'if-eq v0, v1, :handle_go_to_sleep',
-            f'const v1, {hex(596)}',
-            'if-eq v0, v1, :handle_fix_backlight',
-            f'const v1, {hex(600)}',
-            'if-eq v0, v1, :handle_down',
-            f'const v1, {hex(601)}',
-            'if-eq v0, v1, :handle_up',
-            'goto :handle_other_messages',
-
-            ':handle_down',
-            f'iget-object v0, p0, {method.parent.class_name}->this$0:{method.parent.class_name.split("$")[0]};',
-            f'invoke-virtual {{v0}}, {method.parent.class_name.split("$")[0]};->sendPastKeyDownEvent()V',
-            'return-void',
-
-            ':handle_up',
-            f'iget-object v0, p0, {method.parent.class_name}->this$0:{method.parent.class_name.split("$")[0]};',
-            f'invoke-virtual {{v0}}, {method.parent.class_name.split("$")[0]};->sendPastKeyUpEvent()V',
-            'return-void',
-
-            ':handle_fix_backlight',
-            'const-string v2, "sys.linevibrator_touch"',
-            'invoke-static {v2}, Landroid/os/SystemProperties;->get(Ljava/lang/String;)Ljava/lang/String;',
-            'move-result-object v0',
-            ':try_number_type_start',
-            'invoke-static {v0}, Ljava/lang/Integer;->parseInt(Ljava/lang/String;)I',
-            'move-result v0',
-            ':try_number_type_end',
-            '.catchall {:try_number_type_start .. :try_number_type_end} :skip_flipping',
-            'if-gez v0, :skip_flipping',
-            'const v1, 0x0',
-            'sub-int v0, v1, v0',
-            'new-instance v1, Ljava/lang/StringBuilder;',
-            'invoke-direct {v1}, Ljava/lang/StringBuilder;-><init>()V',
-            'invoke-virtual {v1, v0}, Ljava/lang/StringBuilder;->append(I)Ljava/lang/StringBuilder;',
-            'invoke-virtual {v1}, Ljava/lang/StringBuilder;->toString()Ljava/lang/String;',
-            'move-result-object v1',
-            'invoke-static {v2, v1}, Landroid/os/SystemProperties;->set(Ljava/lang/String;Ljava/lang/String;)V',
-            ':skip_flipping',
-            'return-void',
-
-            ':handle_go_to_sleep',
-            f'iget-object v0, p0, {method.parent.class_name}->this$0:{method.parent.class_name.split("$")[0]};',
-            f'iget-object v1, v0, {method.parent.class_name.split("$")[0]};->mPowerManager:Landroid/os/PowerManager;',
-            'invoke-static {}, Landroid/os/SystemClock;->uptimeMillis()J',
-            'move-result-wide v2',
-            'invoke-virtual {v1, v2, v3}, Landroid/os/PowerManager;->goToSleep(J)V',
-            f'invoke-virtual {{v0}}, {method.parent.class_name.split("$")[0]};->forceHideKeyguard()V',
-            'return-void',
-
-            ':handle_other_messages',
-        ])
+        method.first_instruction.expand_after(window_manager_handler_template.instantiate(
+            method,
+            handler_class = method.parent.class_name,
+            manager_class = method.parent.class_name.split("$")[0],
+        ))
 
     JarPatcher(
         "d/system/framework/services.jar",
@@ -859,6 +885,7 @@ def patch_services_jar():
                         action = lambda file: file.smali_class.add_field(".field private mLastDownKeyEvent:Landroid/view/KeyEvent;")
                     ),
                 ],
+                expected_count = 1,
             ),
             FilePatch(
                 file_patterns = [r"PhoneWindowManager[a-zA-Z0-9\$]+Handler\.smali"],
@@ -1002,7 +1029,8 @@ def patch_services_jar():
                         method = "tempStartVibrationLocked",
                         action = lambda method: setattr(method, 'name', 'startVibrationLocked'),
                     ),
-                ]
+                ],
+                isolated_files = False,
             ),
             FilePatch(
                 file_patterns = [r"VibrationScaler\.smali"],
@@ -1015,7 +1043,8 @@ def patch_services_jar():
                         ),
                         action = lambda field: setattr(field, 'value', f'{float(str(field.value)[:-1])**2.0+0.3:.1f}f')
                     ),
-                ]
+                ],
+                expected_count = 1,
             ),
             FilePatch(
                 file_patterns = [r"ColorFade\.smali"],
@@ -1023,7 +1052,8 @@ def patch_services_jar():
                     InstructionPatch(
                         action = patch_ColorFade
                     ),
-                ]
+                ],
+                expected_count = 1,
             ),
             FilePatch(
                 file_patterns = [r"BurnInProtection.*\.smali"],
@@ -1043,12 +1073,15 @@ def patch_services_jar():
                 file_patterns = [r"AutomaticBrightnessController\S*\.smali"],
                 patches = [
                     InstructionPatch(
-                        instruction = InstructionDetails(
-                            InstructionType.METHOD_INVOKE,
-                            method = Matcher.regex(r"(getBrightness|convertToFloatScale)"),
-                            return_type = "F",
-                            class_name = Matcher.regex(r".*BrightnessMappingStrategy.*"),
-                        ),
+                        instruction = SequencePattern([
+                            InstructionDetails(
+                                InstructionType.METHOD_INVOKE,
+                                method = Matcher.regex(r"(getBrightness|convertToFloatScale)"),
+                                return_type = "F",
+                                class_name = Matcher.regex(r".*BrightnessMappingStrategy.*"),
+                            ),
+                            InstructionDetails(InstructionType.MOVE_RESULT),
+                        ]),
                         action = patch_GetBrightness
                     ),
                     InstructionPatch(
@@ -1071,7 +1104,9 @@ def patch_services_jar():
                     ),
                 ],
             )
-        ]
+        ],
+        workers = PATCH_WORKERS,
+        cache_dir = PATCH_CACHE_DIR,
     ).patch(api = 29)
 
 def patch_systemui():
@@ -1087,28 +1122,21 @@ def patch_systemui():
         },
     }
     scrim_enum_triples = list((key1, key2, value) for key1, nested_dict in values_per_scrim_enum.items() for key2, value in nested_dict.items())
-    wallpaper_flag_count = 0
     def patch_WallpaperFlags(instruction):
-        nonlocal wallpaper_flag_count
         next_instruction = instruction.next_known()
         registers = next_instruction.next.get_n_free_registers(1)
+        normal_label = instruction.parent.new_label('ambient_cond_normal')
         next_instruction.expand_after([
             f'iget-boolean {registers[0]}, {instruction.registers[0]}, {instruction.parent.parent.class_name}->mInAmbientMode:Z',
-            f'if-eqz {registers[0]}, :ambient_cond_{wallpaper_flag_count}_normal',
+            f'if-eqz {registers[0]}, {normal_label}',
             f'const {registers[0]}, 0x1',
-            f'if-ne {registers[0]}, {next_instruction.registers[0]}, :ambient_cond_{wallpaper_flag_count}_normal',
+            f'if-ne {registers[0]}, {next_instruction.registers[0]}, {normal_label}',
             f'const {next_instruction.registers[0]}, 0x2',
-            f':ambient_cond_{wallpaper_flag_count}_normal',
+            normal_label,
         ])
-        wallpaper_flag_count+=1
 
-    def patch_UnlockedScreenOffAnimationController(instruction):
-        invoke_instruction = instruction.next_known()
-        if invoke_instruction.instruction_type != InstructionType.METHOD_INVOKE or len(invoke_instruction.registers) == 0 or invoke_instruction.registers[-1] != instruction.registers[0]:
-            return
-        result_instruction = invoke_instruction.next_known()
-        if result_instruction.instruction_type != InstructionType.MOVE_RESULT:
-            return
+    def patch_UnlockedScreenOffAnimationController(match):
+        result_instruction = match[-1]
         if "object" in result_instruction.modifier:
             result_instruction.insert_after(f"const-string {result_instruction.registers[0]}, \"1\"")
         else:
@@ -1123,8 +1151,7 @@ def patch_systemui():
 
     def patch_ImageWallpaperEngine(smali_file):
         smali_file.smali_class.add_field('.field private volatile mInAmbientMode:Z')
-        smali_file.smali_class.items.append((
-            'method',
+        smali_file.smali_class.add_method(
             SmaliMethod(
                 '.method public onAmbientModeChanged(ZJ)V',
                 smali_file.smali_class,
@@ -1156,7 +1183,7 @@ def patch_systemui():
                     'return-void',
                 ]
             )
-        ))
+        )
         smali_file.smali_class.for_instruction(
             InstructionDetails(
                 instruction_type = InstructionType.METHOD_INVOKE,
@@ -1235,10 +1262,17 @@ def patch_systemui():
                 file_patterns = [r"UnlockedScreenOffAnimationController.*\.smali"],
                 patches = [
                     InstructionPatch(
-                        instruction = InstructionDetails(
-                            instruction_type = InstructionType.CONSTANT,
-                            constant_value = Matcher.regex(rf'(?i)"?animator_duration_scale"?'),
-                        ),
+                        instruction = SequencePattern([
+                            SequenceStep(
+                                InstructionDetails(
+                                    instruction_type = InstructionType.CONSTANT,
+                                    constant_value = Matcher.regex(rf'(?i)"?animator_duration_scale"?'),
+                                ),
+                                bind = {'setting': 0},
+                            ),
+                            SequenceStep(InstructionDetails(InstructionType.METHOD_INVOKE), bind = {'setting': -1}),
+                            InstructionDetails(InstructionType.MOVE_RESULT),
+                        ]),
                         action = patch_UnlockedScreenOffAnimationController,
                     ),
                 ],
@@ -1357,11 +1391,14 @@ def patch_systemui():
                 file_patterns = [r".*KeyguardViewMediator.*\.smali"],
                 patches = [
                     InstructionPatch(
-                        instruction = InstructionDetails(
-                          instruction_type = InstructionType.CONSTANT,
-                          constant_value = Matcher.regex(r'"?com.android.systemui:BOUNCER_DOZING"?'),
-                        ),
-                        action = lambda inst: inst.next_known().remove() if inst.next_known() is not None and inst.next_known().method == "wakeUp" else None
+                        instruction = SequencePattern([
+                            InstructionDetails(
+                              instruction_type = InstructionType.CONSTANT,
+                              constant_value = Matcher.regex(r'"?com.android.systemui:BOUNCER_DOZING"?'),
+                            ),
+                            InstructionDetails(method = "wakeUp"),
+                        ]),
+                        action = lambda match: match[-1].remove()
                     ),
                 ]
             ),
@@ -1373,7 +1410,9 @@ def patch_systemui():
                     )
                 ]
             ),
-        ]
+        ],
+        workers = PATCH_WORKERS,
+        cache_dir = PATCH_CACHE_DIR,
     ).patch(install = ["d/system/system_ext/priv-app/SystemUI/SystemUI.apk"], sign = True, api = 29)
 
 def patch_AddTintToCall():
@@ -1510,11 +1549,21 @@ def update_vndk_rc():
             file.write("    write /sys/class/backlight/aw99703-bl-2/brightness ${sys.linevibrator_short}\n\n")
 
 def main():
-    if len(sys.argv) != 2:
-        logging.error("Usage: sudo python patch_system_img.py [/path/to/system.img]")
+    global PATCH_WORKERS, PATCH_CACHE_DIR
+    args = sys.argv[1:]
+    while len(args) > 2 and args[0] in ('--workers', '--cache'):
+        if args[0] == '--workers':
+            if not args[1].isdigit() or int(args[1]) == 0:
+                break
+            PATCH_WORKERS = int(args[1])
+        else:
+            PATCH_CACHE_DIR = os.path.abspath(args[1])
+        args = args[2:]
+    if len(args) != 1:
+        logging.error("Usage: sudo python patch_system_img.py [--workers N] [--cache DIR] [/path/to/system.img]")
         exit_now(1)
 
-    src_file = os.path.abspath(sys.argv[1])
+    src_file = os.path.abspath(args[0])
     if not os.path.exists(src_file):
         logging.error(f"File not found: {src_file}")
         exit_now(1)
@@ -1,4 +1,4 @@
 #!/bin/bash
 #Usage:
-#sudo bash patch_system_img.sh [/path/to/system.img]
-python patch_system_img.py "$1"
\ No newline at end of file
+#sudo bash patch_system_img.sh [--workers N] [--cache DIR] [/path/to/system.img]
+python patch_system_img.py "$@"
\ No newline at end of file
@@ -1,11 +1,18 @@
 from string import Formatter
 from abc import ABC, abstractmethod
 import os
+import sys
+import marshal
+import hashlib
 import shutil
 import difflib
 import re
+import bisect
 import logging
 import subprocess
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from typing import List, Callable, Optional, Any
 from dataclasses import dataclass
 from enum import Enum, auto
@@ -17,6 +24,14 @@ class MatchStrategy(Enum):
     CONTAINS = auto()
     CHOICE = auto()
 
+MATCH_STRATEGY_COST = {
+    MatchStrategy.ANY: 0,
+    MatchStrategy.EXACT: 0,
+    MatchStrategy.CHOICE: 1,
+    MatchStrategy.CONTAINS: 2,
+    MatchStrategy.REGEX: 3,
+}
+
 @dataclass(frozen=True)
 class Matcher:
     strategy: MatchStrategy
@@ -62,6 +77,43 @@ class Matcher:
     def choice(*patterns: str):
         return Matcher(MatchStrategy.CHOICE, [pattern if isinstance(pattern, Matcher) else Matcher(MatchStrategy.EXACT, pattern) for pattern in patterns])
 
+    def compile(self) -> Callable[[Any], bool]:
+        if self.strategy == MatchStrategy.ANY:
+            return lambda other: True
+        elif self.strategy == MatchStrategy.CHOICE:
+            exact_values = set()
+            predicates = []
+            for v in self.value:
+                if v.strategy == MatchStrategy.EXACT and v.value.__hash__ is not None:
+                    exact_values.add(intern_value(v.value))
+                else:
+                    predicates.append(v.compile())
+
+            def matches_choice(other):
+                try:
+                    if other in exact_values:
+                        return True
+                except TypeError:
+                    pass
+                return any(predicate(other) for predicate in predicates)
+            return matches_choice
+        elif self.strategy == MatchStrategy.EXACT:
+            value = intern_value(self.value)
+            return lambda other: other is value or other == value
+        elif self.strategy == MatchStrategy.REGEX:
+            pattern_match = re.compile(self.value).match
+            return lambda other: pattern_match(str(other)) is not None
+        elif self.strategy == MatchStrategy.CONTAINS:
+            if isinstance(self.value, Matcher):
+                predicate = self.value.compile()
+                return lambda other: any(predicate(v) for v in other)
+            value = self.value
+            return lambda other: any(value == v for v in other)
+        return lambda other: False
+
+    def cost(self) -> int:
+        return MATCH_STRATEGY_COST[self.strategy]
+
     def __str__(self):
         if self.strategy == MatchStrategy.EXACT:
             return str(self.value)
@@ -86,6 +138,100 @@ class Details:
                 return False
         return True
 
+    def compile(self) -> Callable[[Any], bool]:
+        checks = []
+        for field in self.__dataclass_fields__:
+            value = getattr(self, field)
+            if value is None:
+                continue
+            if isinstance(value, Matcher):
+                if value.strategy == MatchStrategy.ANY:
+                    continue
+                checks.append((value.cost(), field, value.compile()))
+            else:
+                checks.append((0, field, lambda other, value=intern_value(value): other is value or other == value))
+        checks.sort(key=lambda check: check[0])
+        return compile_checks([(field, predicate) for _, field, predicate in checks])
+
+    def required_literals(self) -> List[tuple]:
+        # Every matched value is a substring of the smali source, so each exact string in the
+        # search has to appear in a file for the search to match anything in it.
+        literals = []
+        for field in self.__dataclass_fields__:
+            alternatives = literal_alternatives(getattr(self, field))
+            if alternatives is not None:
+                literals.append(alternatives)
+        return literals
+
+def compile_checks(checks: List[tuple]) -> Callable[[Any], bool]:
+    if len(checks) == 0:
+        return lambda other: True
+    if len(checks) == 1:
+        (field, predicate), = checks
+        return lambda other: predicate(getattr(other, field))
+    if len(checks) == 2:
+        (first_field, first_predicate), (second_field, second_predicate) = checks
+        return lambda other: first_predicate(getattr(other, first_field)) and second_predicate(getattr(other, second_field))
+
+    def matches_all(other):
+        for field, predicate in checks:
+            if not predicate(getattr(other, field)):
+                return False
+        return True
+    return matches_all
+
+def literal_alternatives(value: Any) -> Optional[tuple]:
+    if isinstance(value, str):
+        return (value.encode(),)
+    if not isinstance(value, Matcher):
+        return None
+    if value.strategy == MatchStrategy.EXACT:
+        return literal_alternatives(value.value)
+    if value.strategy == MatchStrategy.CONTAINS and isinstance(value.value, str):
+        return (value.value.encode(),)
+    if value.strategy == MatchStrategy.CHOICE:
+        alternatives = [literal_alternatives(choice) for choice in value.value]
+        if all(choice is not None for choice in alternatives):
+            return tuple(literal for choice in alternatives for literal in choice)
+    return None
+
+def required_literals(search: Any) -> List[tuple]:
+    if isinstance(search, (Details, SequencePattern)):
+        return search.required_literals()
+    return []
+
+def register_filter(value: Any) -> Any:
+    # Instructions hold Register values, so names like 'v0' in a registers filter are
+    # parsed here rather than never matching. Regex matchers see the names already.
+    if isinstance(value, Matcher):
+        if value.strategy in (MatchStrategy.EXACT, MatchStrategy.CONTAINS):
+            return Matcher(value.strategy, register_filter(value.value))
+        if value.strategy == MatchStrategy.CHOICE:
+            return Matcher(value.strategy, [register_filter(choice) for choice in value.value])
+        return value
+    if isinstance(value, (list, tuple)):
+        return [register_filter(register) for register in value]
+    if isinstance(value, Register):
+        return value
+    if isinstance(value, str) and REGISTER_NAME_PATTERN.fullmatch(value.strip()) is not None:
+        return parse_register(value.strip())
+    raise ValueError(f"Not a register in registers filter: {value!r}")
+
+def intern_value(value: Any) -> Any:
+    return sys.intern(value) if type(value) is str else value
+
+def exact_value(value: Any) -> Any:
+    if isinstance(value, Matcher):
+        return value.value if value.strategy == MatchStrategy.EXACT else None
+    return value
+
+def compile_filter(search: Any) -> Optional[Callable[[Any], bool]]:
+    if search is None:
+        return None
+    if isinstance(search, (Details, Matcher, SequencePattern)):
+        return search.compile()
+    return search
+
 @dataclass
 class InstructionDetails(Details):
     instruction_type: Matcher = None
@@ -100,6 +246,44 @@ class InstructionDetails(Details):
     label: Matcher = None
     constant_value: Matcher = None
 
+    def __post_init__(self):
+        if self.registers is not None:
+            self.registers = register_filter(self.registers)
+
+    def compile(self) -> Callable[[Any], bool]:
+        predicate = super().compile()
+        instruction_types = self.accepted_instruction_types()
+        if instruction_types is not None and InstructionType.UNKNOWN not in instruction_types:
+            matches_details = predicate
+            predicate = lambda instruction: instruction.may_be(instruction_types) and matches_details(instruction)
+            if len(instruction_types) == 1:
+                instruction_type, = instruction_types
+            else:
+                instruction_type = None
+        else:
+            instruction_type = None
+
+        class_name = exact_value(self.class_name)
+        method = exact_value(self.method)
+        field_name = exact_value(self.field_name)
+        invoke = (class_name, method) if method is not None else None
+        field = (class_name, field_name) if field_name is not None else None
+        if instruction_type is not None or invoke is not None or field is not None:
+            predicate.index_key = (instruction_type, invoke, field)
+        return predicate
+
+    def accepted_instruction_types(self) -> Optional[frozenset]:
+        instruction_type = self.instruction_type
+        if isinstance(instruction_type, InstructionType):
+            return frozenset([instruction_type])
+        if not isinstance(instruction_type, Matcher):
+            return None
+        if instruction_type.strategy == MatchStrategy.EXACT:
+            return frozenset([instruction_type.value])
+        if instruction_type.strategy == MatchStrategy.CHOICE and all(v.strategy == MatchStrategy.EXACT for v in instruction_type.value):
+            return frozenset(v.value for v in instruction_type.value)
+        return None
+
 @dataclass
 class FieldDetails(Details):
     name: Matcher = None
@@ -107,6 +291,16 @@ class FieldDetails(Details):
     type: Matcher = None
     value: Matcher = None
 
+    def compile(self) -> Callable[[Any], bool]:
+        predicate = super().compile()
+        name = exact_value(self.name)
+        field_type = exact_value(self.type)
+        if name is not None:
+            predicate.member_name = name
+            if field_type is not None:
+                predicate.member_descriptor = f"{name}:{field_type}"
+        return predicate
+
 @dataclass
 class MethodDetails(Details):
     name: Matcher = None
@@ -114,6 +308,17 @@ class MethodDetails(Details):
     return_type: Matcher = None
     access_modifiers: Matcher = None
 
+    def compile(self) -> Callable[[Any], bool]:
+        predicate = super().compile()
+        name = exact_value(self.name)
+        parameters = exact_value(self.parameters)
+        return_type = exact_value(self.return_type)
+        if name is not None:
+            predicate.member_name = name
+            if parameters is not None and return_type is not None:
+                predicate.member_descriptor = f"{name}({parameters}){return_type}"
+        return predicate
+
 class InstructionType(Enum):
     FIELD_READ = auto()
     FIELD_WRITE = auto()
@@ -134,6 +339,96 @@ class InstructionType(Enum):
             return any(map(self.matches, other))
         return other == self
 
+@dataclass
+class SequenceStep:
+    instruction: InstructionDetails = None
+    # Other instructions allowed between the previous step and this one, None for any number.
+    max_gap: Optional[int] = 0
+    # Names bound to register positions of the matched instruction; a name bound by an
+    # earlier step has to hold the same register here.
+    bind: dict = None
+
+@dataclass
+class SequencePattern:
+    steps: list
+    # Instructions that never count as a step or towards a gap, as with next_known().
+    skip: frozenset = frozenset([InstructionType.UNKNOWN, InstructionType.EMPTY])
+
+    def compile(self) -> 'SequenceAutomaton':
+        return SequenceAutomaton(self)
+
+    def required_literals(self) -> List[tuple]:
+        return [literals for step in self.sequence_steps() for literals in required_literals(step.instruction)]
+
+    def sequence_steps(self) -> List[SequenceStep]:
+        return [step if isinstance(step, SequenceStep) else SequenceStep(step) for step in self.steps]
+
+class SequenceMatch(list):
+    def __init__(self, instructions: list, bindings: dict):
+        super().__init__(instructions)
+        self.bindings = bindings
+
+class SequenceAutomaton:
+    # One state per step. The walk carries every partial match forward together, so each
+    # instruction of a method is looked at once however many candidates are open.
+    def __init__(self, pattern: SequencePattern):
+        steps = pattern.sequence_steps()
+        if len(steps) == 0:
+            raise ValueError("Sequence pattern without steps")
+        self.predicates = [compile_filter(step.instruction) or (lambda instruction: True) for step in steps]
+        self.gaps = [step.max_gap for step in steps]
+        self.bindings = [tuple((step.bind or {}).items()) for step in steps]
+        self.skip = frozenset(pattern.skip)
+
+    def advance(self, state: int, instruction: 'SmaliInstruction', bound: dict) -> Optional[dict]:
+        if not self.predicates[state](instruction):
+            return None
+        if len(self.bindings[state]) == 0:
+            return bound
+        bound = dict(bound)
+        registers = instruction.registers or []
+        for name, index in self.bindings[state]:
+            try:
+                register = registers[index]
+            except IndexError:
+                return None
+            if bound.setdefault(name, register) != register:
+                return None
+        return bound
+
+    def find(self, method: 'SmaliMethod') -> List[SequenceMatch]:
+        # Each open match takes the first instruction within its gap that fits the next step.
+        last_state = len(self.predicates) - 1
+        matches = []
+        threads = []
+        for instruction in method.iterate_instructions():
+            advanced = []
+            if len(threads) > 0:
+                skipped = instruction.instruction_type in self.skip
+                for thread in threads:
+                    state, gap, bound, matched = thread
+                    if skipped:
+                        advanced.append(thread)
+                        continue
+                    result = self.advance(state, instruction, bound)
+                    if result is None:
+                        if self.gaps[state] is None or gap < self.gaps[state]:
+                            advanced.append((state, gap + 1, bound, matched))
+                    elif state == last_state:
+                        matches.append(SequenceMatch(matched + [instruction], result))
+                    else:
+                        advanced.append((state + 1, 0, result, matched + [instruction]))
+
+            bound = self.advance(0, instruction, {})
+            if bound is not None:
+                if last_state == 0:
+                    matches.append(SequenceMatch([instruction], bound))
+                else:
+                    advanced.append((1, 0, bound, [instruction]))
+            threads = advanced
+        matches.sort(key=lambda match: match[0].position)
+        return matches
+
 def run_command(command, check = True, quiet = False):
     if not quiet:
         logging.info(f"Running command: {command}")
@@ -147,9 +442,162 @@ def run_command(command, check = True, quiet = False):
         logging.error(f"Output: {e.output}")
         raise
 
+SKELETON_VERSION = 1
+SKELETON_CACHE_SIZE = 64 * 1024 * 1024
+
+class SkeletonCache:
+    # Member skeletons from parse_members stored with marshal, one file per class body. The
+    # key covers the text, the skeleton layout and the interpreter, since marshal output is
+    # only readable by the same Python version. Loading an entry touches it, and prune()
+    # drops the least recently used entries once the directory is over max_bytes.
+    def __init__(self, directory: str, max_bytes: int = SKELETON_CACHE_SIZE):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.tag = f"{SKELETON_VERSION}:{sys.implementation.cache_tag}:".encode()
+
+    def key(self, source: str) -> str:
+        return hashlib.blake2b(self.tag + source.encode(), digest_size=20).hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def load(self, key: str) -> Optional[list]:
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as file:
+                data = file.read()
+            os.utime(path)
+        except OSError:
+            return None
+        try:
+            return marshal.loads(data)
+        except (EOFError, ValueError, TypeError):
+            return None
+
+    def store(self, key: str, skeleton: list):
+        path = self.path(key)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(temp_path, 'wb') as file:
+                file.write(marshal.dumps(skeleton))
+            os.replace(temp_path, path)
+        except OSError as ex:
+            logging.warning(f"Couldn't write parse cache entry {key}: {ex}")
+
+    def prune(self):
+        try:
+            entries = [entry for entry in os.scandir(self.directory) if entry.is_file()]
+        except OSError:
+            return
+        stats = []
+        for entry in entries:
+            try:
+                stats.append((entry.stat().st_mtime, entry.stat().st_size, entry.path))
+            except OSError:
+                continue
+        total = sum(size for _, size, _ in stats)
+        for _, size, path in sorted(stats):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+class Workspace:
+    # State shared by every patch applied during one JarPatcher run. Names are interned
+    # through sys.intern so they are the same objects as the exact values of compiled
+    # filters, while the table keeps them alive only as long as the run.
+    def __init__(self, file_patches: List['FilePatch'] = [], cache: Optional['SkeletonCache'] = None):
+        self.names = {}
+        self.diffs = DiffBundle()
+        self.file_patches = file_patches
+        self.files: Optional['FileIndex'] = None
+        self.symbols: Optional['SymbolIndex'] = None
+        self.cache = cache
+        self.models = SmaliFileCache()
+
+    def file_index(self) -> 'FileIndex':
+        if self.files is None:
+            self.files = FileIndex(self.file_patches, symbols=self.symbols)
+        return self.files
+
+    def symbol_index(self) -> 'SymbolIndex':
+        return self.file_index().symbol_index()
+
+    def write_back(self):
+        for filename, changes in self.models.write_back():
+            self.diffs.add(filename, changes)
+
+    def intern(self, value: Optional[str]) -> Optional[str]:
+        if value is None:
+            return None
+        interned = self.names.get(value)
+        if interned is None:
+            interned = self.names[value] = sys.intern(value)
+        return interned
+
+MODEL_CACHE_SIZE = 256 * 1024 * 1024
+# Files are written from this many threads at most, whatever the number of worker processes.
+WRITE_BACK_THREADS = 8
+
+def save_model(path: str, smali_file: 'SmaliFile') -> List[tuple]:
+    changes = smali_file.save_file()
+    return [(os.path.normpath(path), changes)] if len(changes) > 0 else []
+
+class SmaliFileCache:
+    # Parsed files of one process, shared by every FilePatch, least recently used first.
+    # The size counts source characters. Files are saved when evicted or by write_back(),
+    # so each one is written once unless the cap forces it out and it is loaded again.
+    def __init__(self, max_size: int = MODEL_CACHE_SIZE):
+        self.max_size = max_size
+        self.files = OrderedDict()
+        self.size = 0
+        self.saved: List[tuple] = []
+
+    def get(self, path: str) -> Optional['SmaliFile']:
+        smali_file = self.files.get(path)
+        if smali_file is not None:
+            self.files.move_to_end(path)
+        return smali_file
+
+    def add(self, path: str, smali_file: 'SmaliFile'):
+        self.files[path] = smali_file
+        self.size += len(smali_file.content)
+        while self.size > self.max_size and len(self.files) > 1:
+            evicted_path, evicted = self.files.popitem(last=False)
+            self.size -= len(evicted.content)
+            self.saved += save_model(evicted_path, evicted)
+
+    def write_back(self) -> List[tuple]:
+        files = list(self.files.items())
+        self.files.clear()
+        self.size = 0
+        threads = min(WRITE_BACK_THREADS, len(files))
+        if threads > 1:
+            with ThreadPoolExecutor(threads) as executor:
+                saved = list(executor.map(lambda item: save_model(*item), files))
+        else:
+            saved = [save_model(*item) for item in files]
+        results = self.saved + [result for results in saved for result in results]
+        self.saved = []
+        return results
+
 class JarPatcher:
-    def __init__(self, target_file, patchers = []):
+    def __init__(
+        self, target_file, patchers = [], workers = 1, cache_dir = None, cache_size = SKELETON_CACHE_SIZE,
+        index_symbols = False,
+    ):
+        # cache_dir keeps parsed member skeletons between runs; there is no cache without it.
+        # index_symbols builds the SymbolIndex of the decompiled tree up front, and keeps it
+        # in the symbols directory of the cache, keyed by the content of the target file.
         self.target_file = target_file
+        self.workers = workers
+        self.cache = SkeletonCache(os.path.abspath(cache_dir), cache_size) if cache_dir is not None else None
+        self.index_symbols = index_symbols
+        self.symbol_cache = SkeletonCache(os.path.join(self.cache.directory, "symbols"), cache_size) if self.cache is not None else None
         no_dir_file = target_file.rsplit('/', 1)[-1]
         self.file_name, self.file_extensions = no_dir_file.rsplit('.', 1)
         self.temp_dir_name = f"temp_{self.file_name}"
@@ -158,8 +606,28 @@ class JarPatcher:
     def add_smali_patcher(self, patcher):
         self.patchers.append(patcher)
 
+    def symbols_key(self, use_src, use_res) -> Optional[str]:
+        digest = hashlib.blake2b(self.symbol_cache.tag + f"{SYMBOL_INDEX_VERSION}:{use_src}:{use_res}:".encode(), digest_size=20)
+        try:
+            with open(self.target_file, 'rb') as file:
+                for chunk in iter(lambda: file.read(1024 * 1024), b''):
+                    digest.update(chunk)
+        except OSError:
+            return None
+        return digest.hexdigest()
+
+    def load_symbols(self, key: Optional[str]) -> 'SymbolIndex':
+        references = self.symbol_cache.load(key) if key is not None else None
+        if isinstance(references, dict):
+            return SymbolIndex(references)
+        symbols = SymbolIndex.scan(list(scan_files(".")))
+        if key is not None:
+            self.symbol_cache.store(key, symbols.references)
+        return symbols
+
     def patch(self, install = [], sign = False, use_src = True, use_res = False, copy_meta_inf = True, api = None):
         os.makedirs(self.temp_dir_name, exist_ok = True)
+        symbols_key = self.symbols_key(use_src, use_res) if self.index_symbols and self.symbol_cache is not None else None
 
         for f in install:
             run_command(f"apktool if {f}")
@@ -168,11 +636,25 @@ class JarPatcher:
 
         os.chdir(self.temp_dir_name)
         try:
-            for patcher in self.patchers:
-                patcher.apply()
-            for file in os.listdir("."):
-                if os.path.isfile(file) and file.endswith('.diff'):
-                    shutil.move(file, f'../{self.file_name}_{file}')
+            workspace = Workspace([patcher for patcher in self.patchers if isinstance(patcher, FilePatch)], self.cache)
+            if self.index_symbols:
+                workspace.symbols = self.load_symbols(symbols_key)
+            file_patches = []
+            for patcher in self.patchers + [None]:
+                if isinstance(patcher, FilePatch):
+                    file_patches.append(patcher)
+                    continue
+                if len(file_patches) > 0:
+                    apply_file_patches(file_patches, workspace, self.workers)
+                    file_patches = []
+                if patcher is not None:
+                    workspace.write_back()
+                    patcher.apply(workspace)
+            workspace.write_back()
+            workspace.diffs.write(f'../{self.file_name}.diff')
+            if self.cache is not None:
+                self.cache.prune()
+                self.symbol_cache.prune()
 
         except Exception as ex:
             logging.error(ex)
@@ -199,179 +681,929 @@ class JarPatcher:
         shutil.move(temp_apk_name, self.target_file)
         shutil.rmtree(self.temp_dir_name)
 
+class PatchCountError(Exception):
+    pass
+
+def remaining_count(limit: Optional[int], count: int) -> Optional[int]:
+    return limit - count if limit is not None else None
+
 @dataclass(frozen=True)
 class InstructionPatch:
     action: Callable
     method: Matcher = None
     instruction: Matcher = None
     field: Matcher = None
+    # Matches per file: the walk stops at max_count, or at expected_count, which it also has
+    # to reach.
+    expected_count: Optional[int] = None
+    max_count: Optional[int] = None
     def __post_init__(self):
         if isinstance(self.method, str):
             object.__setattr__(self, 'method', MethodDetails(name = self.method))
+        object.__setattr__(self, 'limit', self.max_count if self.max_count is not None else self.expected_count)
+        object.__setattr__(self, 'method_predicate', compile_filter(self.method))
+        object.__setattr__(self, 'instruction_predicate', compile_filter(self.instruction))
+        object.__setattr__(self, 'field_predicate', compile_filter(self.field))
+        alternatives = []
+        if self.field is not None:
+            alternatives.append(required_literals(self.field))
+        if self.method is not None or self.instruction is not None:
+            alternatives.append(required_literals(self.method) + required_literals(self.instruction))
+        if len(alternatives) == 0:
+            alternatives.append([])
+        object.__setattr__(self, 'required_literals', alternatives)
+
+    def may_match(self, data: bytes) -> bool:
+        return any(
+            all(any(literal in data for literal in group) for group in literals)
+            for literals in self.required_literals
+        )
+
+    def check_count(self, count: int, filename: str):
+        if self.expected_count is not None and count != self.expected_count:
+            target = self.instruction or self.method or self.field or 'file'
+            raise PatchCountError(
+                f"{getattr(self.action, '__name__', self.action)} on {target} matched {count} times in {filename}, expected {self.expected_count}"
+            )
+
+def scan_files(root: str):
+    # (name, path) of every file under root, in the order os.walk would list them.
+    files = []
+    directories = []
+    try:
+        with os.scandir(root) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    if not entry.is_symlink():
+                        directories.append(entry.path)
+                else:
+                    files.append((entry.name, entry.path))
+    except OSError:
+        return
+    yield from files
+    for directory in directories:
+        yield from scan_files(directory)
+
+HEADER_END_DIRECTIVES = (b'.field', b'.method', b'.annotation')
+
+@dataclass(frozen=True)
+class ClassHeader:
+    name: str
+    path: str
+    superclass: Optional[str] = None
+    interfaces: tuple = ()
+    source: Optional[str] = None
+    is_interface: bool = False
+
+def scan_class_header(path: str) -> Optional[ClassHeader]:
+    # Reads the lines before the first annotation or member, which is where baksmali puts
+    # the .class, .super, .source and .implements directives.
+    name = superclass = source = None
+    interfaces = []
+    is_interface = False
+    try:
+        with open(path, 'rb') as file:
+            for line in file:
+                words = line.split()
+                if len(words) < 2:
+                    continue
+                if words[0] == b'.class':
+                    name = sys.intern(words[-1].decode())
+                    is_interface = b'interface' in words[1:-1]
+                elif words[0] == b'.super':
+                    superclass = sys.intern(words[1].decode())
+                elif words[0] == b'.implements':
+                    interfaces.append(sys.intern(words[1].decode()))
+                elif words[0] == b'.source':
+                    source = line.strip()[len(b'.source'):].strip().strip(b'"').decode()
+                elif words[0].startswith(HEADER_END_DIRECTIVES):
+                    break
+    except (OSError, UnicodeDecodeError):
+        return None
+    if name is None:
+        return None
+    return ClassHeader(name, path, superclass, tuple(interfaces), source, is_interface)
+
+class ClassHierarchy:
+    # Superclass and interfaces of every class in the tree, from the headers alone, so that
+    # patches can select classes by what they extend without parsing them.
+    def __init__(self, files: List[tuple]):
+        self.classes = {}
+        self.subclasses = {}
+        self.implementors = {}
+        for name, path in files:
+            if not name.endswith('.smali'):
+                continue
+            header = scan_class_header(path)
+            if header is None:
+                continue
+            self.classes[header.name] = header
+            if header.superclass is not None:
+                self.subclasses.setdefault(header.superclass, []).append(header.name)
+            for interface in header.interfaces:
+                self.implementors.setdefault(interface, []).append(header.name)
+
+    def subclasses_of(self, class_name: str) -> set:
+        # Direct and indirect subclasses, without the class itself.
+        found = set()
+        pending = [class_name]
+        while len(pending) > 0:
+            for subclass in self.subclasses.get(pending.pop(), ()):
+                if subclass not in found:
+                    found.add(subclass)
+                    pending.append(subclass)
+        return found
+
+    def implementors_of(self, interface: str) -> set:
+        # Classes implementing the interface themselves, through an interface extending it
+        # or through a superclass. Interfaces are followed but not returned.
+        found = set()
+        seen = {interface}
+        pending = [interface]
+        while len(pending) > 0:
+            for implementor in self.implementors.get(pending.pop(), ()):
+                if implementor in seen:
+                    continue
+                seen.add(implementor)
+                pending.append(implementor)
+                if not self.classes[implementor].is_interface:
+                    found.add(implementor)
+                    found.update(self.subclasses_of(implementor))
+        return found
+
+    def paths_of(self, class_names: set) -> set:
+        return {self.classes[class_name].path for class_name in class_names if class_name in self.classes}
+
+SYMBOL_INDEX_VERSION = 1
+SYMBOL_LINE_PATTERN = re.compile(
+    rb'^[ \t]*(?:(?P<end>\.end method)|\.method[ \t][^\n]*?(?P<method>[^\s]+)'
+    rb'|(?P<op>[^\s]+)[ \t][^\n]*?(?P<class>[^\s,{}"]+)->(?P<name>[^\s(:]+)(?P<descriptor>\([^)\s]*\)[^\s,]+|:[^\s,]+))'
+    rb'(?:[ \t]+#[^\n]*)?[ \t\r]*$',
+    re.M,
+)
+REFERENCE_KINDS = ((b'invoke', 'invoke'), (b'iget', 'read'), (b'sget', 'read'), (b'iput', 'write'), (b'sput', 'write'))
+
+def reference_kind(op: bytes) -> str:
+    for prefix, kind in REFERENCE_KINDS:
+        if op.startswith(prefix):
+            return kind
+    return 'other'
+
+def scan_symbols(data: bytes) -> List[tuple]:
+    # (class, name, descriptor, kind, method) of every method and field reference, found
+    # line by line without parsing the file. method is None outside of method bodies.
+    references = set()
+    method = None
+    for match in SYMBOL_LINE_PATTERN.finditer(data):
+        if match.group('end') is not None:
+            method = None
+        elif match.group('method') is not None:
+            method = match.group('method').decode()
+        elif not match.group('op').startswith(b'const-string'):
+            references.add((
+                match.group('class').decode(), match.group('name').decode(), match.group('descriptor').decode(),
+                reference_kind(match.group('op')), method,
+            ))
+    return sorted(references, key=lambda reference: tuple(value or '' for value in reference))
+
+def parse_reference(reference: str) -> tuple:
+    # "Lclass;->name(params)return", "Lclass;->name:type" or "Lclass;->name" for any descriptor.
+    class_name, member = reference.split('->', 1)
+    split = min([position for position in (member.find('('), member.find(':')) if position >= 0], default=len(member))
+    return class_name, member[:split], member[split:] or None
+
+class SymbolIndex:
+    # Method and field references of every smali file as it was decompiled, keyed by class
+    # and member name, so that the files using an API can be found without opening any of
+    # them. Each entry is (descriptor, path, method, kind) with kind one of invoke, read,
+    # write or other.
+    def __init__(self, references: Optional[dict] = None):
+        self.references = references if references is not None else {}
+
+    @classmethod
+    def scan(cls, files: List[tuple]) -> 'SymbolIndex':
+        index = cls()
+        for name, path in files:
+            if not name.endswith('.smali'):
+                continue
+            try:
+                with open(path, 'rb') as file:
+                    data = file.read()
+            except OSError:
+                continue
+            index.add_file(path, data)
+        return index
+
+    def add_file(self, path: str, data: bytes):
+        for class_name, name, descriptor, kind, method in scan_symbols(data):
+            self.references.setdefault((sys.intern(class_name), sys.intern(name)), []).append(
+                (sys.intern(descriptor), path, method, kind)
+            )
+
+    def find(self, reference: str, kind: Optional[str] = None) -> List[tuple]:
+        # (path, method, kind) of every use of the reference.
+        class_name, name, descriptor = parse_reference(reference)
+        return [
+            (path, method, found_kind)
+            for found_descriptor, path, method, found_kind in self.references.get((class_name, name), ())
+            if (descriptor is None or found_descriptor == descriptor) and (kind is None or found_kind == kind)
+        ]
+
+    def files_referencing(self, reference: str, kind: Optional[str] = None) -> List[str]:
+        return list(dict.fromkeys(path for path, _, _ in self.find(reference, kind)))
+
+    def files_invoking(self, reference: str) -> List[str]:
+        return self.files_referencing(reference, 'invoke')
+
+class FileIndex:
+    # The decompiled tree is scanned once per run, and the patterns of all FilePatches are
+    # combined by combine_patterns() so that most files are rejected by a single match. FilePatches
+    # that select classes by superclass, interface or the members they use are matched
+    # through the class hierarchy and the symbol index, which are only read when one of
+    # them asks for it, unless the symbol index was loaded by the caller.
+    def __init__(self, file_patches: List['FilePatch'], root: str = ".", symbols: Optional['SymbolIndex'] = None):
+        self.files = list(scan_files(root))
+        self.positions = {path: position for position, (name, path) in enumerate(self.files)}
+        name_patches = [file_patch for file_patch in file_patches if not file_patch.selects_classes]
+        self.matches = {file_patch: [] for file_patch in name_patches}
+        self.match_sets = {}
+        self.classes: Optional[ClassHierarchy] = None
+        self.symbols = symbols
+        combined = combine_patterns([pattern for file_patch in name_patches for pattern in file_patch.patterns])
+        for name, path in self.files:
+            if combined is not None and not combined(name):
+                continue
+            for file_patch in name_patches:
+                if file_patch.matches_name(name):
+                    self.matches[file_patch].append(path)
+
+    def hierarchy(self) -> ClassHierarchy:
+        if self.classes is None:
+            self.classes = ClassHierarchy(self.files)
+        return self.classes
+
+    def symbol_index(self) -> 'SymbolIndex':
+        if self.symbols is None:
+            self.symbols = SymbolIndex.scan(self.files)
+        return self.symbols
+
+    def files_for(self, file_patch: 'FilePatch') -> List[str]:
+        paths = self.matches.get(file_patch)
+        if paths is None:
+            if file_patch.selects_classes:
+                paths = self.class_files(file_patch)
+            else:
+                paths = [path for name, path in self.files if file_patch.matches_name(name)]
+            self.matches[file_patch] = paths
+        return paths
+
+    def class_files(self, file_patch: 'FilePatch') -> List[str]:
+        paths = set()
+        if len(file_patch.subclasses_of) > 0 or len(file_patch.implementors_of) > 0:
+            hierarchy = self.hierarchy()
+            class_names = set()
+            for class_name in file_patch.subclasses_of:
+                class_names.update(hierarchy.subclasses_of(class_name))
+            for interface in file_patch.implementors_of:
+                class_names.update(hierarchy.implementors_of(interface))
+            paths = hierarchy.paths_of(class_names)
+        for reference in file_patch.references:
+            paths.update(self.symbol_index().files_referencing(reference))
+        return [
+            path for name, path in self.files
+            if path in paths and (len(file_patch.file_patterns) == 0 or file_patch.matches_name(name))
+        ]
+
+    def wants(self, file_patch: 'FilePatch', path: str) -> bool:
+        paths = self.match_sets.get(file_patch)
+        if paths is None:
+            paths = self.match_sets[file_patch] = frozenset(self.files_for(file_patch))
+        return path in paths
+
+def combine_patterns(patterns: List[re.Pattern]) -> Optional[Callable[[str], bool]]:
+    # One alternation of every pattern that can go in it unchanged. Patterns with groups are
+    # matched on their own, since the groups of the patterns before them would renumber
+    # their groups and backreferences, and so are patterns with inline flags, which would
+    # apply to all of them.
+    if len(patterns) == 0:
+        return None
+    shared = [pattern for pattern in patterns if pattern.groups == 0 and pattern.flags == re.UNICODE]
+    separate = [pattern for pattern in patterns if pattern not in shared]
+    combined = re.compile('|'.join(f'(?:{pattern.pattern})' for pattern in shared)) if len(shared) > 0 else None
+
+    def matches(name: str) -> bool:
+        return (combined is not None and combined.match(name) is not None) or any(pattern.match(name) for pattern in separate)
+    return matches
 
 class FilePatch:
-    def __init__(self, file_patterns: List[str], patches: List[InstructionPatch]):
+    def __init__(
+        self, file_patterns: List[str], patches: List[InstructionPatch], isolated_files: bool = True,
+        expected_count: Optional[int] = None, max_count: Optional[int] = None,
+        subclasses_of: List[str] = [], implementors_of: List[str] = [], references: List[str] = [],
+    ):
+        # isolated_files = False keeps every file of this patch in one task, for actions
+        # that carry state from one file to the next. expected_count and max_count are
+        # checked against the number of files patched once every file has been through.
+        # subclasses_of and implementors_of take class descriptors and select the classes
+        # extending any of them, references ("Lclass;->name" with an optional descriptor) the
+        # classes using any of them. file_patterns then only narrows those down, and may be
+        # empty.
         self.file_patterns = file_patterns
         self.patches = patches
+        self.isolated_files = isolated_files
+        self.expected_count = expected_count
+        self.max_count = max_count
+        self.subclasses_of = list(subclasses_of)
+        self.implementors_of = list(implementors_of)
+        self.references = list(references)
+        self.selects_classes = len(self.subclasses_of) > 0 or len(self.implementors_of) > 0 or len(self.references) > 0
+        self.patterns = [re.compile(pattern) for pattern in file_patterns]
+
+    def matches_name(self, name: str) -> bool:
+        return any(pattern.match(name) for pattern in self.patterns)
+
+    def apply(self, workspace: Optional[Workspace] = None, workers: int = 1):
+        if workspace is None:
+            # Nothing else will flush a workspace made here, so the files and their diffs
+            # are written before returning.
+            workspace = Workspace()
+            apply_file_patches([self], workspace, workers)
+            workspace.write_back()
+            workspace.diffs.write_per_file()
+        else:
+            apply_file_patches([self], workspace, workers)
 
-    def apply(self):
-        patterns = [re.compile(pattern) for pattern in self.file_patterns]
-        matching_files = []
-
-        for root, dirs, files in os.walk("."):
-            for file in files:
-                if any(pattern.match(file) for pattern in patterns):
-                    matching_files.append(os.path.join(root, file))
-
-        for file in matching_files:
-            smali_file = SmaliFile(file)
-
-            with open(file, 'r') as f:
-                cont_temp = f.read()
-
-            for patch in self.patches:
-                if patch.field is not None:
-                    if smali_file.smali_class:
-                        for f in smali_file.smali_class.get_fields(patch.field):
-                            patch.action(f)
-
-                if patch.method is None and patch.instruction is not None:
-                    smali_file.for_instruction(patch.instruction, patch.action)
-                elif patch.instruction is None and patch.method is not None:
-                    smali_file.for_method(
-                        patch.method,
-                        patch.action
-                    )
-                elif patch.instruction is not None and patch.method is not None:
-                    smali_file.for_method(
-                        patch.method,
-                        action=lambda m: m.for_instruction(patch.instruction, patch.action)
-                    )
-                elif patch.field is None:
-                    patch.action(smali_file)
+    def load(self, file: str, workspace: Workspace) -> Optional['SmaliFile']:
+        with open(file, 'rb') as f:
+            data = f.read()
+        if not any(patch.may_match(data) for patch in self.patches):
+            return None
+        return SmaliFile(file, workspace, decode_text(data))
+
+    def check_count(self, count: int):
+        if self.expected_count is not None and count != self.expected_count:
+            raise PatchCountError(f"Patch for {self.file_patterns} matched {count} files, expected {self.expected_count}")
+        if self.max_count is not None and count > self.max_count:
+            raise PatchCountError(f"Patch for {self.file_patterns} matched {count} files, expected at most {self.max_count}")
+
+    def check_skipped(self, filename: str):
+        # A file rejected before parsing has no match for any patch, which the per file
+        # counts still have to be checked against.
+        for patch in self.patches:
+            patch.check_count(0, os.path.normpath(filename))
+
+    def apply_to(self, smali_file: 'SmaliFile') -> int:
+        # Returns the number of matches of all patches in this file.
+        counts = [0] * len(self.patches)
+        fused_patches = []
+        for index, patch in enumerate(self.patches + [None]):
+            if patch is not None and patch.field is None and patch.instruction is not None and not isinstance(patch.instruction, SequencePattern):
+                fused_patches.append(index)
+                continue
+            if len(fused_patches) > 0:
+                fused_counts = smali_file.smali_class.apply_instruction_patches([self.patches[fused] for fused in fused_patches])
+                for fused, count in zip(fused_patches, fused_counts):
+                    counts[fused] = count
+                fused_patches = []
+            if patch is None:
+                break
 
-            smali_file.save_file()
+            if patch.field is not None and patch.limit != 0:
+                if smali_file.smali_class:
+                    for f in smali_file.smali_class.get_fields(patch.field_predicate):
+                        patch.action(f)
+                        counts[index] += 1
+                        if counts[index] == patch.limit:
+                            break
+
+            if patch.method is None and patch.instruction is not None:
+                counts[index] += smali_file.for_instruction(patch.instruction_predicate, patch.action, patch.limit)
+            elif patch.instruction is None and patch.method is not None:
+                counts[index] += smali_file.for_method(patch.method_predicate, patch.action, patch.limit)
+            elif patch.instruction is not None and patch.method is not None:
+                def for_method_instructions(method, patch=patch, index=index):
+                    counts[index] += method.for_instruction(
+                        patch.instruction_predicate, patch.action, remaining_count(patch.limit, counts[index])
+                    )
+                smali_file.for_method(patch.method_predicate, for_method_instructions)
+            elif patch.field is None:
+                smali_file.smali_class.dirty = True
+                patch.action(smali_file)
+                counts[index] += 1
+
+        for patch, count in zip(self.patches, counts):
+            patch.check_count(count, os.path.normpath(smali_file.filename))
+        return sum(counts)
+
+def build_patch_tasks(file_patches: List[FilePatch], workspace: Workspace) -> List[List[str]]:
+    # Groups the matched files into tasks that can be patched independently: one file per
+    # task, except that the files of a FilePatch without isolated_files stay together.
+    index = workspace.file_index()
+    group_of = {}
+
+    def find(path):
+        while group_of[path] != path:
+            group_of[path] = group_of[group_of[path]]
+            path = group_of[path]
+        return path
+
+    for file_patch in file_patches:
+        paths = index.files_for(file_patch)
+        for path in paths:
+            group_of.setdefault(path, path)
+        if not file_patch.isolated_files:
+            for path in paths[1:]:
+                first, other = find(paths[0]), find(path)
+                if first != other:
+                    group_of[max(first, other, key=index.positions.get)] = min(first, other, key=index.positions.get)
+
+    tasks = {}
+    for path in sorted(group_of, key=index.positions.get):
+        tasks.setdefault(find(path), []).append(path)
+    return list(tasks.values())
+
+def run_patch_task(file_patches: List[FilePatch], paths: List[str], workspace: Workspace) -> List[int]:
+    # FilePatches run in order over the files of the task on the models kept in the
+    # workspace, which are saved later by write_back(). Returns how many files each
+    # FilePatch matched.
+    index = workspace.file_index()
+    models = workspace.models
+    matched_files = [0] * len(file_patches)
+    for patch_number, file_patch in enumerate(file_patches):
+        for path in paths:
+            if not index.wants(file_patch, path):
+                continue
+            smali_file = models.get(path)
+            if smali_file is None:
+                smali_file = file_patch.load(path, workspace)
+                if smali_file is None:
+                    file_patch.check_skipped(path)
+                    continue
+                models.add(path, smali_file)
+            if file_patch.apply_to(smali_file) > 0:
+                matched_files[patch_number] += 1
+    return matched_files
+
+PATCH_PHASE = None
+
+def run_forked_patch_task(task_number: int) -> tuple:
+    # Models of a worker process are not seen by the parent, so they are saved right away.
+    file_patches, tasks, workspace = PATCH_PHASE
+    matched_files = run_patch_task(file_patches, tasks[task_number], workspace)
+    return matched_files, workspace.models.write_back()
+
+def apply_file_patches(file_patches: List[FilePatch], workspace: Workspace, workers: int = 1):
+    # Tasks are spread over forked worker processes, which inherit the patches and their
+    # closures. Without workers the files stay in workspace.models for later phases.
+    global PATCH_PHASE
+    tasks = build_patch_tasks(file_patches, workspace)
+    workers = min(workers, len(tasks))
+    matched_files = [0] * len(file_patches)
+    if workers <= 1 or 'fork' not in multiprocessing.get_all_start_methods():
+        for paths in tasks:
+            task_matches = run_patch_task(file_patches, paths, workspace)
+            matched_files = [total + count for total, count in zip(matched_files, task_matches)]
+    else:
+        # Workers would otherwise start from copies of models the parent has not saved yet.
+        workspace.write_back()
+        PATCH_PHASE = (file_patches, tasks, workspace)
+        try:
+            with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('fork')) as executor:
+                results = list(executor.map(
+                    run_forked_patch_task, range(len(tasks)),
+                    chunksize=max(1, len(tasks) // (workers * 4)),
+                ))
+        finally:
+            PATCH_PHASE = None
+        for task_matches, task_results in results:
+            matched_files = [total + count for total, count in zip(matched_files, task_matches)]
+            for filename, changes in task_results:
+                workspace.diffs.add(filename, changes)
+    for file_patch, count in zip(file_patches, matched_files):
+        file_patch.check_count(count)
 
 class FunctionPatch:
     def __init__(self, action):
         self.action = action
 
-    def apply(self):
+    def apply(self, workspace: Optional[Workspace] = None):
         self.action()
+        if workspace is not None:
+            workspace.files = None
 
 class SmaliPiece:
-    def __getattr__(self, name):
-        if name == 'details':
-            return None
-        return getattr(self.details, name)
-    def __setattr__(self, name, value):
-        if name != 'details' and name in dir(self.details):
-            setattr(self.details, name, value)
-        else:
-            super().__setattr__(name, value)
+    __slots__ = ()
+
+    def matches(self, search_details: Details) -> bool:
+        return search_details.matches(self)
 
-def compare_changes(old, new):
+def non_empty_lines(lines):
+    return [line for line in lines if len(line.strip()) > 0]
+
+def compare_changes(old, new, fromfile = "OLD", tofile = "NEW"):
     diff = list(difflib.unified_diff(
-        [line for line in old if len(line.strip()) > 0],
-        [line for line in new if len(line.strip()) > 0],
-        fromfile="OLD",
-        tofile="NEW",
+        non_empty_lines(old),
+        non_empty_lines(new),
+        fromfile=fromfile,
+        tofile=tofile,
         lineterm=''
     ))
 
     return diff
 
+class DiffBundle:
+    # Changes collected while patching one archive. Only the changed members of each file
+    # are kept, and difflib runs on them when the bundle is written, ordered by file name
+    # since files are saved in whatever order they leave the workspace.
+    def __init__(self):
+        self.changes: List[tuple] = []
+
+    def add(self, filename: str, changes: List[tuple]):
+        self.changes.append((filename, changes))
+
+    def lines(self, changes: Optional[List[tuple]] = None):
+        for filename, file_changes in sorted(changes if changes is not None else self.changes, key=lambda change: change[0]):
+            yield f"--- OLD/{filename}"
+            yield f"+++ NEW/{filename}"
+            for old, new in file_changes:
+                yield from compare_changes(old, new)[2:]
+            yield '-' * 60
+
+    def write(self, filename: str) -> bool:
+        if len(self.changes) == 0:
+            return False
+        with open(filename, 'w') as file:
+            for line in self.lines():
+                file.write(line + '\n')
+        return True
+
+    def write_per_file(self):
+        # One diff per changed file in the current directory, named after the file, as
+        # patches applied on their own have always written them.
+        for change in self.changes:
+            with open(os.path.split(change[0])[1].rsplit('.', 1)[0] + '.diff', 'w') as file:
+                for line in self.lines([change]):
+                    file.write(line + '\n')
+
+def decode_text(data: bytes) -> str:
+    # Same text as reading the file in text mode, with universal newlines.
+    return data.decode().replace('\r\n', '\n').replace('\r', '\n')
+
 class SmaliFile:
-    def __init__(self, filename: str):
+    def __init__(self, filename: str, workspace: Optional[Workspace] = None, content: Optional[str] = None):
         self.filename = filename
+        self.workspace = workspace
         self.smali_class = None
-        self.load_file()
-
-    def load_file(self):
-        with open(self.filename, 'r') as file:
-            self.content = file.read()
-        self.smali_class = SmaliClass(self.content)
-
-    def save_file(self, filename: str = None):
+        self.load_file(content)
+
+    def load_file(self, content: Optional[str] = None):
+        if content is None:
+            with open(self.filename, 'r') as file:
+                content = file.read()
+        self.content = content
+        self.smali_class = SmaliClass(self.content, self.workspace)
+
+    def save_file(self, filename: str = None) -> List[tuple]:
+        if not self.smali_class.is_dirty():
+            return []
         if filename is None:
             filename = self.filename
-        new_content = str(self.smali_class)
-        if self.content != new_content:
-            diff = compare_changes(self.content.splitlines(), new_content.splitlines())
-            if len(diff) > 0:
-                filename_no_dir = os.path.split(filename)[1]
-                logging.info(f'Modified file {filename_no_dir}')
-                with open(filename_no_dir.rsplit('.', 1)[0]+'.diff', 'w') as file:
-                    for line in diff:
-                        file.write(line + '\n')
-                    file.write('-' * 60 + '\n')
-                self.content = new_content
-                with open(filename, 'w') as file:
-                    file.write(new_content)
-
-    def for_method(self, method: Matcher, action: Callable[['SmaliMethod'], None]):
-        self.smali_class.for_method(method, action)
-
-    def for_instruction(self, instruction_details: InstructionDetails, action: Callable[['SmaliInstruction'], None]):
-        self.smali_class.for_instruction(instruction_details, action)
+        changes = self.smali_class.changed_members()
+        if len(changes) == 0:
+            return []
+        filename_no_dir = os.path.split(filename)[1]
+        logging.info(f'Modified file {filename_no_dir}')
+        self.content = str(self.smali_class)
+        with open(filename, 'w') as file:
+            file.write(self.content)
+        return changes
+
+    def for_method(self, method: Matcher, action: Callable[['SmaliMethod'], None], limit: Optional[int] = None) -> int:
+        return self.smali_class.for_method(method, action, limit)
+
+    def for_instruction(self, instruction_details: InstructionDetails, action: Callable[['SmaliInstruction'], None], limit: Optional[int] = None) -> int:
+        return self.smali_class.for_instruction(instruction_details, action, limit)
+
+    def for_sequence(self, pattern: SequencePattern, action: Callable[[SequenceMatch], None], limit: Optional[int] = None) -> int:
+        return self.smali_class.for_sequence(pattern, action, limit)
 
     def __str__(self):
         return str(self.smali_class)
 
+LINE_BREAKS = '\n\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029'
+METHOD_HEADER_PATTERN = re.compile(r'\.method\s+(?P<modifiers>(\S+[\t \f]+)*)(?P<name>\S+)\((?P<parametes>.*?)\)(?P<return_type>\S+)')
+FIELD_PATTERN = re.compile(r'\.field\s+(?P<modifiers>([^\s:="]+[\t \f]+)*)(?P<name>[^\s:="]+):(?P<type>[^\s=]+)(\s*=\s*(?P<value>[^\n]+))?[ \t\f]*$')
+
+def parse_method_header(header_line: str) -> Optional[tuple]:
+    match = METHOD_HEADER_PATTERN.search(header_line)
+    if not match:
+        return None
+    if match.group(1):
+        access_modifiers = [mod.strip() for mod in match.group('modifiers').split() if mod.strip()]
+    else:
+        access_modifiers = []
+    return (match.group('name'), match.group('parametes'), match.group('return_type'), access_modifiers)
+
+def parse_field_line(line: str) -> Optional[tuple]:
+    match = FIELD_PATTERN.match(line)
+    if not match:
+        return None
+    return (
+        match.group('name'),
+        match.group('type'),
+        list(map(str.strip, match.group('modifiers').strip().split())),
+        match.group('value').strip() if match.group('value') is not None else None,
+    )
+
+def parse_members(source: str) -> list:
+    # The members of a class body as plain values, so they can be kept in a SkeletonCache.
+    # Methods keep the offsets of their body instead of its lines.
+    items = []
+    offset = 0
+    method = None
+    for raw_line in source.splitlines(keepends=True):
+        start = offset
+        offset += len(raw_line)
+        raw_line = raw_line.rstrip(LINE_BREAKS)
+        line = raw_line.strip()
+        if line.startswith('.method'):
+            if method is not None:
+                method[4] = start
+            method = ['method', line, None, offset, None, parse_method_header(line)]
+            method_start = start
+            items.append(method)
+        elif line.startswith('.end method'):
+            if method is not None:
+                method[2] = (method_start, start + len(raw_line))
+                method[4] = start
+            method = None
+        elif method is not None:
+            continue
+        elif line.startswith('.field'):
+            items.append(('field', raw_line, (start, start + len(raw_line)), parse_field_line(raw_line)))
+        elif not line.startswith('.class'):
+            items.append(('unknown', raw_line))
+    if method is not None:
+        method[4] = offset
+    return items
+
+class MemberTable:
+    def __init__(self):
+        self.members = []
+        self.by_name = {}
+        self.by_descriptor = {}
+        self.stale = True
+
+    def rebuild(self, members: list):
+        # The members list is refilled in place so walks over it survive a rebuild.
+        self.members[:] = members
+        self.by_name = {}
+        self.by_descriptor = {}
+        for member in members:
+            self.by_name.setdefault(member.name, []).append(member)
+            self.by_descriptor.setdefault(member.descriptor, member)
+        self.stale = False
+
+    def add(self, member: Any, position: Optional[int] = None):
+        if self.stale:
+            return
+        if position is None or position >= len(self.members):
+            self.members.append(member)
+            self.by_name.setdefault(member.name, []).append(member)
+            self.by_descriptor.setdefault(member.descriptor, member)
+            return
+        self.members.insert(position, member)
+        bucket = self.by_name.setdefault(member.name, [])
+        bucket.insert(sum(1 for other in self.members[:position] if other.name == member.name), member)
+        existing = self.by_descriptor.get(member.descriptor)
+        if existing is None or self.members.index(existing) > position:
+            self.by_descriptor[member.descriptor] = member
+
+    def find(self, predicate: Callable[[Any], bool]) -> list:
+        descriptor = getattr(predicate, 'member_descriptor', None)
+        if descriptor is not None:
+            member = self.by_descriptor.get(descriptor)
+            return [member] if member is not None else []
+        name = getattr(predicate, 'member_name', None)
+        if name is not None:
+            return self.by_name.get(name, [])
+        return self.members
+
+class SmaliMembers(list):
+    # SmaliClass.items: (kind, object) tuples in file order, with method and field tables
+    # kept up to date on append and rebuilt after any other change to the list.
+    def __init__(self):
+        super().__init__()
+        self.tables = {'method': MemberTable(), 'field': MemberTable()}
+        self.field_position: Optional[int] = None
+        self.dirty = False
+        self.restructured = False
+
+    def table(self, kind: str) -> MemberTable:
+        table = self.tables[kind]
+        if table.stale:
+            table.rebuild([member for item_kind, member in self if item_kind == kind])
+        return table
+
+    def changed(self):
+        for table in self.tables.values():
+            table.stale = True
+        self.field_position = None
+        self.dirty = True
+        self.restructured = True
+
+    def renamed(self, kind: str, member: Any, old_name: Optional[str]):
+        table = self.tables[kind]
+        if not table.stale and any(other is member for other in table.by_name.get(old_name, ())):
+            table.stale = True
+
+    def append(self, item: tuple):
+        if self.field_position is not None and self.field_position >= len(self):
+            self.field_position = None
+        super().append(item)
+        self.dirty = True
+        table = self.tables.get(item[0])
+        if table is not None:
+            table.add(item[1])
+        else:
+            self.restructured = True
+
+    def add_field(self, field: 'SmaliField'):
+        # New fields go right after the first field, or before the first method.
+        if self.field_position is None:
+            self.field_position = len(self)
+            for position, (kind, _) in enumerate(self):
+                if kind == 'field':
+                    self.field_position = position + 1
+                    break
+                if kind == 'method':
+                    self.field_position = position
+                    break
+        position = self.field_position
+        after_field = position > 0 and self[position - 1][0] == 'field'
+        super().insert(position, ('field', field))
+        self.dirty = True
+        self.tables['field'].add(field, 1 if after_field else 0)
+        self.field_position = position if after_field else position + 1
+
+    def extend(self, items):
+        for item in items:
+            self.append(item)
+
+    def __iadd__(self, items):
+        self.extend(items)
+        return self
+
+    def insert(self, position, item):
+        super().insert(position, item)
+        self.changed()
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.changed()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.changed()
+
+    def pop(self, position = -1):
+        item = super().pop(position)
+        self.changed()
+        return item
+
+    def remove(self, item):
+        super().remove(item)
+        self.changed()
+
+    def clear(self):
+        super().clear()
+        self.changed()
+
+    def sort(self, *args, **kwargs):
+        super().sort(*args, **kwargs)
+        self.changed()
+
+    def reverse(self):
+        super().reverse()
+        self.changed()
+
 class SmaliClass(SmaliPiece):
-    def __init__(self, content: str):
-        self.items: List[tuple] = []
+    def __init__(self, content: str, workspace: Optional[Workspace] = None):
+        self.items = SmaliMembers()
+        self.workspace = workspace if workspace is not None else Workspace()
         self.class_name = ""
         self.base_dir = ""
         self.class_modifiers = []
+        self.source = ""
         self.parse_content(content)
-
-    def for_method(self, method: Matcher, action: Callable[['SmaliMethod'], None]):
-        for item_name, searched_method in self.items:
-            if item_name != 'method':
-                continue
-            if method.matches(searched_method.details):
+        self.original_header = self.header()
+        self.items.dirty = False
+        self.items.restructured = False
+        self.dirty = False
+
+    def is_dirty(self) -> bool:
+        return self.dirty or self.items.dirty
+
+    @property
+    def methods(self) -> List['SmaliMethod']:
+        return self.items.table('method').members
+
+    @property
+    def fields(self) -> List['SmaliField']:
+        return self.items.table('field').members
+
+    def find_methods(self, method: Any) -> List['SmaliMethod']:
+        predicate = compile_filter(method)
+        return [candidate for candidate in self.items.table('method').find(predicate) if predicate(candidate)]
+
+    def for_method(self, method: Matcher, action: Callable[['SmaliMethod'], None], limit: Optional[int] = None) -> int:
+        # Runs action on at most limit methods and returns how many it ran on.
+        predicate = compile_filter(method)
+        count = 0
+        for searched_method in self.items.table('method').find(predicate):
+            if count == limit:
+                break
+            if predicate(searched_method):
+                searched_method.mark_dirty()
                 action(searched_method)
+                count += 1
+        return count
 
     def has_method(self, method: Matcher):
-        for item_name, searched_method in self.items:
-            if item_name != 'method':
-                continue
-            if method.matches(searched_method.details):
-                return True
-        return False
-
-    def for_instruction(self, instruction_details: InstructionDetails, action: Callable[['SmaliInstruction'], None]):
-        for item_name, method in self.items:
-            if item_name != 'method':
-                continue
-            method.for_instruction(instruction_details, action)
+        predicate = compile_filter(method)
+        return any(predicate(searched_method) for searched_method in self.items.table('method').find(predicate))
+
+    def for_instruction(self, instruction_details: InstructionDetails, action: Callable[['SmaliInstruction'], None], limit: Optional[int] = None) -> int:
+        predicate = compile_filter(instruction_details)
+        count = 0
+        for method in self.methods:
+            if count == limit:
+                break
+            count += method.for_instruction(predicate, action, remaining_count(limit, count))
+        return count
+
+    def for_sequence(self, pattern: SequencePattern, action: Callable[[SequenceMatch], None], limit: Optional[int] = None) -> int:
+        return self.for_instruction(compile_filter(pattern), action, limit)
+
+    def apply_instruction_patches(self, patches: List['InstructionPatch']) -> List[int]:
+        # Returns the number of matches of each patch. Patches that reached their limit are
+        # left out of the remaining methods, and the walk ends once all of them have.
+        counts = [0] * len(patches)
+
+        def counted(index):
+            patch = patches[index]
+            predicate = patch.instruction_predicate
+            if patch.limit is not None:
+                matches = predicate
+                predicate = lambda instruction: counts[index] < patch.limit and matches(instruction)
+
+            def action(instruction):
+                counts[index] += 1
+                patch.action(instruction)
+            return (predicate, action)
+
+        for method in self.methods:
+            method_patches = [
+                index for index, patch in enumerate(patches)
+                if counts[index] != patch.limit and (patch.method_predicate is None or patch.method_predicate(method))
+            ]
+            if len(method_patches) == 1:
+                index, = method_patches
+                patch = patches[index]
+                counts[index] += method.for_instruction(
+                    patch.instruction_predicate, patch.action, remaining_count(patch.limit, counts[index])
+                )
+            elif len(method_patches) > 1:
+                method.for_instructions([counted(index) for index in method_patches])
+            if all(count == patch.limit for count, patch in zip(counts, patches)):
+                break
+        return counts
 
     def get_fields(self, field_details):
-        for item_name, field in self.items:
-            if item_name != 'field':
-                continue
-            if field.matches(field_details):
+        predicate = compile_filter(field_details)
+        for field in self.items.table('field').find(predicate):
+            if predicate(field):
+                field.mark_dirty()
                 yield field
 
     def add_field(self, field):
         if isinstance(field, str):
             field = SmaliField(field, self)
-        field = ('field', field)
-        for i in range(len(self.items)):
-            if self.items[i][0] == 'field':
-                self.items.insert(i+1, field)
-                return
-            if self.items[i][0] == 'method':
-                self.items.insert(i, field)
-                return
-        self.items.append(field)
+        self.items.add_field(field)
+        return field
+
+    def add_method(self, method: 'SmaliMethod'):
+        self.items.append(('method', method))
+        return method
+
+    def member_renamed(self, kind: str, member: Any, old_name: Optional[str]):
+        self.items.renamed(kind, member, old_name)
 
     def parse_content(self, content: str):
         class_regex = r'\.class\s+([\w\s]+\s+)?([^;\s]+);'
         class_match = re.search(class_regex, content)
         if class_match:
-            self.class_name = class_match.group(2)+";"
+            self.class_name = self.workspace.intern(class_match.group(2)+";")
             class_split = self.class_name.split('/')
             if len(class_split) > 1:
                 self.base_dir = '/'.join(class_split[:-1])
@@ -381,79 +1613,584 @@ class SmaliClass(SmaliPiece):
                 self.class_modifiers = []
             content = re.sub(class_regex+'\n', '', content)
 
-        lines = content.splitlines()
-        current_method = None
-        for raw_line in lines:
-            line = raw_line.strip()
-            if line.startswith('.method'):
-                current_method = SmaliMethod(line, self)
-                self.items.append(('method', current_method))
-            elif line.startswith('.end method'):
-                current_method = None
-            elif current_method:
-                current_method.add_instruction(raw_line)
-            elif line.startswith('.field'):
-                self.items.append(('field', SmaliField(raw_line, self)))
-            elif not line.startswith('.class'):
-                self.items.append(('unknown', raw_line))
+        # Methods and fields keep the span of their original text so untouched ones are
+        # written back verbatim.
+        self.source = content
+        cache = self.workspace.cache
+        skeleton = None
+        if cache is not None:
+            key = cache.key(content)
+            skeleton = cache.load(key)
+        if skeleton is None:
+            skeleton = parse_members(content)
+            if cache is not None:
+                cache.store(key, skeleton)
+        self.load_members(skeleton)
+
+    def load_members(self, skeleton: list):
+        for item in skeleton:
+            kind = item[0]
+            if kind == 'method':
+                _, header, span, body_start, body_end, parsed_header = item
+                method = SmaliMethod(header, self, self.source[body_start:body_end].splitlines(), parsed_header)
+                method.span = span
+                self.items.append(('method', method))
+            elif kind == 'field':
+                _, line, span, parsed_field = item
+                field = SmaliField(line, self, parsed_field)
+                field.span = span
+                self.items.append(('field', field))
+            else:
+                self.items.append(item)
 
-    def __str__(self):
+    def header(self) -> str:
         modifiers = ' '.join(self.class_modifiers) + (' ' if len(self.class_modifiers) > 0 else '')
-        class_header = f".class {modifiers}{self.class_name}"
-        return f"{class_header}\n" + "\n".join(str(item[1]) for item in self.items) + ("\n" if len(self.items) > 0 else "")
+        return f".class {modifiers}{self.class_name}"
+
+    def changed_members(self) -> List[tuple]:
+        # (old lines, new lines) for each added or edited member, ignoring empty lines.
+        if self.items.restructured:
+            old = [self.original_header] + self.source.splitlines()
+            new = str(self).splitlines()
+            return [(old, new)] if non_empty_lines(old) != non_empty_lines(new) else []
+        changes = []
+        header = self.header()
+        if header != self.original_header:
+            changes.append(([self.original_header], [header]))
+        for kind, member in self.items:
+            if kind == 'unknown':
+                continue
+            if member.span is None:
+                old = []
+            elif member.dirty:
+                old = non_empty_lines(self.source[member.span[0]:member.span[1]].splitlines())
+            else:
+                continue
+            new = non_empty_lines(str(member).splitlines())
+            if old != new:
+                changes.append((old, new))
+        return changes
+
+    def __str__(self):
+        return f"{self.header()}\n" + "\n".join(str(item[1]) for item in self.items) + ("\n" if len(self.items) > 0 else "")
+
+
+def instruction_position(instruction: 'SmaliInstruction') -> int:
+    return instruction.position
+
+class InstructionIndex:
+    def __init__(self, method: 'SmaliMethod'):
+        self.method = method
+        self.by_type = {}
+        self.by_invoke = {}
+        self.by_invoke_name = {}
+        self.by_field = {}
+        self.by_field_name = {}
+        self.keys = {}
+        method.renumber()
+        for instruction in method.iterate_instructions():
+            keys = self.instruction_keys(instruction)
+            self.keys[instruction] = keys
+            for table, key in keys:
+                bucket = table.get(key)
+                if bucket is None:
+                    table[key] = [instruction]
+                else:
+                    bucket.append(instruction)
+
+    def instruction_keys(self, instruction: 'SmaliInstruction') -> tuple:
+        if instruction.decoded:
+            instruction_type = instruction.instruction_type
+        elif not instruction.original_line:
+            instruction_type = InstructionType.EMPTY
+        elif instruction.original_line[0] == ':':
+            instruction_type = InstructionType.LABEL
+        else:
+            instruction_type = lookup_opcode(instruction.operation).instruction_type
+        keys = [(self.by_type, instruction_type)]
+        if instruction_type in INDEXED_REFERENCE_TYPES or instruction.decoded:
+            if instruction.method is not None:
+                keys.append((self.by_invoke, (instruction.class_name, instruction.method)))
+                keys.append((self.by_invoke_name, instruction.method))
+            if instruction.field_name is not None:
+                keys.append((self.by_field, (instruction.class_name, instruction.field_name)))
+                keys.append((self.by_field_name, instruction.field_name))
+        return tuple(keys)
+
+    def add(self, instruction: 'SmaliInstruction'):
+        keys = self.instruction_keys(instruction)
+        self.keys[instruction] = keys
+        for table, key in keys:
+            bisect.insort(table.setdefault(key, []), instruction, key=instruction_position)
+
+    def remove(self, instruction: 'SmaliInstruction'):
+        keys = self.keys.pop(instruction, None)
+        if keys is None:
+            return False
+        for table, key in keys:
+            bucket = table[key]
+            position = bisect.bisect_left(bucket, instruction.position, key=instruction_position)
+            while bucket[position] is not instruction:
+                position += 1
+            del bucket[position]
+        return True
+
+    def candidates(self, instruction_type: Optional[InstructionType], invoke: Optional[tuple], field: Optional[tuple]) -> list:
+        buckets = []
+        if instruction_type is not None:
+            buckets.append(self.by_type.setdefault(instruction_type, []))
+        if invoke is not None:
+            if invoke[0] is not None:
+                buckets.append(self.by_invoke.setdefault(invoke, []))
+            else:
+                buckets.append(self.by_invoke_name.setdefault(invoke[1], []))
+        if field is not None:
+            if field[0] is not None:
+                buckets.append(self.by_field.setdefault(field, []))
+            else:
+                buckets.append(self.by_field_name.setdefault(field[1], []))
+        return min(buckets, key=len)
+
+INDEX_AFTER_SEARCHES = 2
+
+INDEXED_REFERENCE_TYPES = frozenset([
+    InstructionType.FIELD_READ,
+    InstructionType.FIELD_WRITE,
+    InstructionType.METHOD_INVOKE,
+])
+
+class BasicBlock:
+    __slots__ = ('instructions', 'successors', 'handlers', 'predecessors', 'is_payload')
+
+    def __init__(self, is_payload: bool = False):
+        self.instructions: List['SmaliInstruction'] = []
+        self.successors: List['BasicBlock'] = []
+        self.handlers: List['BasicBlock'] = []
+        self.predecessors: List['BasicBlock'] = []
+        self.is_payload = is_payload
+
+class ControlFlowGraph:
+    def __init__(self, method: 'SmaliMethod'):
+        self.labels = {}
+        self.blocks: List[BasicBlock] = []
+        self.block_of = {}
+
+        switch_targets = {}
+        try_ranges = []
+        data_label = None
+        payload = None
+        block = None
+        ends_block = True
+        for instruction in method.iterate_instructions():
+            operation = instruction.operation
+            if payload is not None:
+                if operation == '.end':
+                    payload = None
+                elif instruction.original_line.startswith(':'):
+                    payload.append(instruction.original_line)
+                elif '->' in instruction.original_line:
+                    payload.append(instruction.original_line.rsplit('->', 1)[1].strip())
+                block.instructions.append(instruction)
+                self.block_of[instruction] = block
+                continue
+
+            if operation in SWITCH_PAYLOADS:
+                payload = switch_targets.setdefault(data_label, [])
+            elif operation in DATA_PAYLOADS:
+                payload = []
+            elif instruction.instruction_type == InstructionType.LABEL:
+                data_label = instruction.label
+                self.labels.setdefault(instruction.label, instruction)
+                ends_block = True
+            else:
+                match = CATCH_PATTERN.match(instruction.original_line) if operation in CATCH_DIRECTIVES else None
+                if match:
+                    try_ranges.append((match.group('start'), match.group('end'), match.group('handler')))
+
+            if ends_block or payload is not None:
+                block = BasicBlock(is_payload = payload is not None)
+                self.blocks.append(block)
+            block.instructions.append(instruction)
+            self.block_of[instruction] = block
+            ends_block = payload is not None or operation in BLOCK_TERMINATORS or operation.startswith(BRANCH_PREFIXES)
+
+        for position, block in enumerate(self.blocks):
+            last = block.instructions[-1]
+            operation = last.operation
+            falls_through = position + 1 < len(self.blocks) and not block.is_payload \
+                and operation not in NO_FALLTHROUGH and not operation.startswith('goto')
+            if falls_through:
+                self.link(block, self.blocks[position + 1])
+            if operation.startswith(BRANCH_PREFIXES):
+                self.link_label(block, last.label)
+            elif operation in SWITCH_OPERATIONS:
+                for label in switch_targets.get(last.original_line.rsplit(None, 1)[-1], []):
+                    self.link_label(block, label)
+
+        for start, end, handler in try_ranges:
+            if start not in self.labels or end not in self.labels or handler not in self.labels:
+                continue
+            handler_block = self.block_of[self.labels[handler]]
+            first = self.blocks.index(self.block_of[self.labels[start]])
+            last = self.blocks.index(self.block_of[self.labels[end]])
+            for block in self.blocks[first:last]:
+                if handler_block not in block.handlers:
+                    block.handlers.append(handler_block)
+                    handler_block.predecessors.append(block)
+
+    def insert(self, instruction: 'SmaliInstruction') -> bool:
+        if not is_straight_line(instruction):
+            return False
+        prev = instruction.prev
+        block = self.block_of.get(prev)
+        if block is not None:
+            if prev.operation in BLOCK_TERMINATORS or prev.operation.startswith(BRANCH_PREFIXES) or block.is_payload:
+                return False
+            position = len(block.instructions) - 1
+            while block.instructions[position] is not prev:
+                position -= 1
+            block.instructions.insert(position + 1, instruction)
+        elif prev is not None and prev.prev is None and len(self.blocks) > 0 and self.blocks[0].instructions[0] is instruction.next:
+            block = self.blocks[0]
+            block.instructions.insert(0, instruction)
+        else:
+            return False
+        self.block_of[instruction] = block
+        return True
+
+    def is_leader(self, instruction: 'SmaliInstruction') -> bool:
+        block = self.block_of.get(instruction)
+        return block is not None and block.instructions[0] is instruction
+
+    def link(self, block: BasicBlock, successor: BasicBlock):
+        if successor not in block.successors:
+            block.successors.append(successor)
+            successor.predecessors.append(block)
+
+    def link_label(self, block: BasicBlock, label: str):
+        target = self.labels.get(label)
+        if target is not None:
+            self.link(block, self.block_of[target])
+
+def is_straight_line(instruction: 'SmaliInstruction') -> bool:
+    operation = instruction.operation
+    if not instruction.original_line or instruction.original_line[0] == ':':
+        return False
+    return operation not in BLOCK_TERMINATORS and not operation.startswith(BRANCH_PREFIXES) \
+        and operation not in CATCH_DIRECTIVES and operation not in SWITCH_PAYLOADS and operation not in DATA_PAYLOADS
+
+REGISTER_V = 0
+REGISTER_P = 1
+WIDE_HINTS = ('wide', 'long', 'double')
+DEFINING_TYPES = frozenset([
+    InstructionType.FIELD_READ,
+    InstructionType.CONSTANT,
+    InstructionType.NEW_INSTANCE,
+    InstructionType.NEW_ARRAY,
+    InstructionType.MOVE,
+])
+
+def register_bits(register: 'Register', wide: bool = False) -> int:
+    if wide:
+        return (1 << register) | (1 << (register + 2))
+    return 1 << register
+
+def register_effects(instruction: 'SmaliInstruction') -> tuple:
+    registers = instruction.registers
+    if not registers:
+        return 0, 0
+    instruction_type = instruction.instruction_type
+    wide = any(hint in instruction.operation for hint in WIDE_HINTS)
+    if instruction_type in DEFINING_TYPES:
+        kill = register_bits(registers[0], wide)
+        use = 0
+        for register in registers[1:]:
+            use |= register_bits(register, wide and instruction_type == InstructionType.MOVE)
+        return use, kill
+    use = 0
+    for register in registers:
+        use |= register_bits(register, wide)
+    return use, 0
+
+class Liveness:
+    def __init__(self, method: 'SmaliMethod'):
+        self.method = method
+        self.flow = method.get_flow()
+        self.effects = {}
+        self.live = {method.first_instruction: 0, method.last_instruction: 0}
+
+        blocks = self.flow.blocks
+        block_live = {block: 0 for block in blocks}
+        pending = set(blocks)
+        worklist = list(blocks)
+        while worklist:
+            block = worklist.pop()
+            pending.discard(block)
+            live = self.block_live_out(block, block_live)
+            handler_live = self.handler_live(block, block_live)
+            for instruction in reversed(block.instructions):
+                live = self.transfer(instruction, live) | handler_live
+            if live != block_live[block]:
+                block_live[block] = live
+                for predecessor in block.predecessors:
+                    if predecessor not in pending:
+                        pending.add(predecessor)
+                        worklist.append(predecessor)
+
+        for block in blocks:
+            live = self.block_live_out(block, block_live)
+            handler_live = self.handler_live(block, block_live)
+            for instruction in reversed(block.instructions):
+                live = self.transfer(instruction, live) | handler_live
+                self.live[instruction] = live
+        if len(blocks) > 0:
+            self.live[method.first_instruction] = block_live[blocks[0]]
+
+    def block_live_out(self, block: BasicBlock, block_live: dict) -> int:
+        live = 0
+        for successor in block.successors:
+            live |= block_live[successor]
+        return live
+
+    def handler_live(self, block: BasicBlock, block_live: dict) -> int:
+        live = 0
+        for handler in block.handlers:
+            live |= block_live[handler]
+        return live
+
+    def transfer(self, instruction: 'SmaliInstruction', live: int) -> int:
+        effects = self.effects.get(instruction)
+        if effects is None:
+            effects = self.effects[instruction] = register_effects(instruction)
+        use, kill = effects
+        return (live & ~kill) | use
+
+    def live_at(self, instruction: 'SmaliInstruction') -> int:
+        live = self.live.get(instruction)
+        if live is None:
+            self.method.liveness = None
+            liveness = self.method.get_liveness()
+            return liveness.live.get(instruction, liveness.live.get(instruction.next, 0))
+        return live
+
+    def insert(self, instruction: 'SmaliInstruction') -> bool:
+        next_live = self.live.get(instruction.next)
+        block = self.flow.block_of.get(instruction)
+        if next_live is None or block is None:
+            return False
+        handler_live = 0
+        for handler in block.handlers:
+            handler_live |= self.live.get(handler.instructions[0], 0)
+        live_before = next_live | handler_live
+        live = self.transfer(instruction, live_before) | handler_live
+        self.live[instruction] = live
+        return self.propagate(instruction, live & ~live_before)
+
+    def propagate(self, instruction: 'SmaliInstruction', added: int) -> bool:
+        worklist = [(instruction, added)]
+        while worklist:
+            instruction, added = worklist.pop()
+            if self.flow.is_leader(instruction):
+                block = self.flow.block_of[instruction]
+                for predecessor in block.predecessors:
+                    if block in predecessor.handlers:
+                        return False
+                upstream = [predecessor.instructions[-1] for predecessor in block.predecessors]
+                if block is self.flow.blocks[0]:
+                    self.live[self.method.first_instruction] |= added
+            elif instruction.prev is not None and instruction.prev.prev is not None:
+                upstream = [instruction.prev]
+            else:
+                upstream = []
+                self.live[self.method.first_instruction] |= added
+            for previous in upstream:
+                live = self.live.get(previous)
+                if live is None:
+                    return False
+                use, kill = self.effects.get(previous) or register_effects(previous)
+                new_bits = added & ~kill & ~live
+                if new_bits:
+                    self.live[previous] = live | new_bits
+                    worklist.append((previous, new_bits))
+        return True
+
+CATCH_PATTERN = re.compile(r'^\.catch(all)?\s.*\{(?P<start>:\S+)\s*\.\.\s*(?P<end>:\S+)\}\s*(?P<handler>:\S+)')
+CATCH_DIRECTIVES = frozenset(['.catch', '.catchall'])
+SWITCH_OPERATIONS = frozenset(['packed-switch', 'sparse-switch'])
+SWITCH_PAYLOADS = frozenset(['.packed-switch', '.sparse-switch'])
+DATA_PAYLOADS = frozenset(['.array-data'])
+NO_FALLTHROUGH = frozenset(['return-void', 'return', 'return-wide', 'return-object', 'throw'])
+BLOCK_TERMINATORS = NO_FALLTHROUGH | SWITCH_OPERATIONS
+BRANCH_PREFIXES = ('goto', 'if-')
+
+LOCALS_PATTERN = re.compile(r'\.locals\s+(\d+)')
+
+def tracked_field(slot: str) -> property:
+    # A member that is not dirty is written out as its original text, so writes to the
+    # fields that are printed mark it dirty.
+    def get(self):
+        return getattr(self, slot)
+
+    def set(self, value):
+        setattr(self, slot, value)
+        self.mark_dirty()
 
+    return property(get, set)
+
+def materialized_field(slot: str) -> property:
+    def get(self):
+        if self.body_lines is not None:
+            self.materialize()
+        return getattr(self, slot)
+
+    return property(get)
 
 class SmaliMethod(SmaliPiece):
-    def __init__(self, header: str, parent: SmaliClass, initial_instructions: list = []):
+    __slots__ = (
+        'header', 'parent', 'index', 'searches', 'flow', 'liveness', 'stale_from', 'span', 'dirty', 'issued_labels',
+        '_name', '_parameters', '_return_type', '_access_modifiers', 'body_lines',
+        '_locals', '_instructions', '_first_instruction', '_last_instruction',
+    )
+
+    def __init__(self, header: str, parent: SmaliClass, initial_instructions: list = [], parsed_header: Optional[tuple] = None):
         self.header = header
         self.parent = parent
-        self.locals = None
-        self.access_modifiers = []
-        self.parse_header(header)
-
-        self.first_instruction = SmaliInstruction("", self)
-        self.last_instruction = SmaliInstruction("", self)
-        self.first_instruction.next = self.last_instruction
-        self.last_instruction.prev = self.first_instruction
-
-        for instruction in initial_instructions:
-            self.add_instruction(instruction)
+        self.span: Optional[tuple] = None
+        self.dirty = False
+        self.issued_labels: Optional[set] = None
+        if parsed_header is None:
+            self.parse_header(header)
+        else:
+            self.set_header(parsed_header)
+        self.body_lines: Optional[List[str]] = initial_instructions
+        self.index: Optional[InstructionIndex] = None
+        self.searches = 0
+        self.flow: Optional[ControlFlowGraph] = None
+        self.liveness: Optional[Liveness] = None
+
+    parameters = tracked_field('_parameters')
+    return_type = tracked_field('_return_type')
+    access_modifiers = tracked_field('_access_modifiers')
+    instructions = materialized_field('_instructions')
+    first_instruction = materialized_field('_first_instruction')
+    last_instruction = materialized_field('_last_instruction')
+
+    @property
+    def locals(self) -> Optional[int]:
+        if self.body_lines is not None:
+            self.materialize()
+        return self._locals
+
+    @locals.setter
+    def locals(self, value: Optional[int]):
+        # The body is read in first, or its .locals line would replace the new value.
+        self.materialize()
+        self._locals = value
+        self.mark_dirty()
+
+    def materialize(self):
+        if self.body_lines is None:
+            return
+        body_lines = self.body_lines
+        self.reset_instructions()
+        self._locals = None
+        instructions = [self._first_instruction]
+        for line in body_lines:
+            stripped = line.strip()
+            if not stripped:
+                continue
+            if stripped.startswith('.locals'):
+                self._locals = int(LOCALS_PATTERN.search(line).group(1))
+            else:
+                instruction = SmaliInstruction(line, self)
+                instruction._position = len(instructions)
+                instructions.append(instruction)
+        self._last_instruction._position = len(instructions)
+        instructions.append(self._last_instruction)
+        self._instructions = instructions
+        self.stale_from = len(instructions)
+
+    def reset_instructions(self):
+        self.body_lines = None
+        self.index = None
+        self.flow = None
+        self.liveness = None
+        self._first_instruction = SmaliInstruction("", self)
+        self._last_instruction = SmaliInstruction("", self)
+        self._first_instruction._position = 0
+        self._last_instruction._position = 1
+        self._instructions: List['SmaliInstruction'] = [self._first_instruction, self._last_instruction]
+        self.stale_from = 2
+
+    @property
+    def name(self) -> Optional[str]:
+        return self._name
+
+    @name.setter
+    def name(self, value: Optional[str]):
+        old_name = getattr(self, '_name', None)
+        self._name = value
+        if old_name is not None and self.parent is not None:
+            self.mark_dirty()
+            self.parent.member_renamed('method', self, old_name)
+
+    def mark_dirty(self):
+        self.dirty = True
+        if self.parent is not None:
+            self.parent.dirty = True
+
+    @property
+    def descriptor(self) -> str:
+        return f"{self.name}({self.parameters}){self.return_type}"
+
+    @property
+    def details(self) -> MethodDetails:
+        return MethodDetails(
+            name = self.name,
+            parameters = self.parameters,
+            return_type = self.return_type,
+            access_modifiers = self.access_modifiers,
+        )
 
     def parse_header(self, header_line: str):
-        method_regex = r'\.method\s+(?P<modifiers>(\S+[\t \f]+)*)(?P<name>\S+)\((?P<parametes>.*?)\)(?P<return_type>\S+)'
-        match = re.search(method_regex, header_line)
-        if match:
-            if match.group(1):
-                access_modifiers = [mod.strip() for mod in match.group('modifiers').split() if mod.strip()]
-            else:
-                access_modifiers = []
-            self.details = MethodDetails(
-                name = match.group('name'),
-                parameters = match.group('parametes'),
-                return_type = match.group('return_type'),
-                access_modifiers = access_modifiers
-            )
+        self.set_header(parse_method_header(header_line))
+
+    def set_header(self, parsed_header: Optional[tuple]):
+        if parsed_header is not None:
+            name, parameters, return_type, access_modifiers = parsed_header
+            intern = self.parent.workspace.intern
+            name, parameters, return_type = intern(name), intern(parameters), intern(return_type)
         else:
-            self.details = MethodDetails()
+            name = parameters = return_type = access_modifiers = None
+        self.name = name
+        self._parameters = parameters
+        self._return_type = return_type
+        self._access_modifiers = access_modifiers
 
     def add_instruction(self, line: str):
-        if len(line.strip()) == 0:
+        self.materialize()
+        if isinstance(line, SmaliInstruction):
+            new_instruction = line
+        elif len(line.strip()) == 0:
+            return
+        elif line.strip().startswith('.locals'):
+            self.locals = int(LOCALS_PATTERN.search(line).group(1))
+            self.mark_dirty()
             return
-
-        if line.strip().startswith('.locals'):
-            self.locals = int(re.search(r'\.locals\s+(\d+)', line).group(1))
         else:
             new_instruction = SmaliInstruction(line, self)
-            last_real_instruction = self.last_instruction.prev
-            last_real_instruction.next = new_instruction
-            new_instruction.prev = last_real_instruction
-            new_instruction.next = self.last_instruction
-            self.last_instruction.prev = new_instruction
+        position = len(self.instructions) - 1
+        self.instructions.insert(position, new_instruction)
+        new_instruction._position = position
+        self.last_instruction._position = position + 1
+        if self.stale_from >= position:
+            self.stale_from = position + 2
+        self.instruction_inserted(new_instruction)
 
     def clear(self):
-        self.first_instruction.next = self.last_instruction
-        self.last_instruction.prev = self.first_instruction
+        self.reset_instructions()
         self.locals = 0
+        self.mark_dirty()
 
     def replace_with_lines(self, lines, locals=0):
         self.clear()
@@ -463,42 +2200,420 @@ class SmaliMethod(SmaliPiece):
 
 
     def construct_header(self):
-        access_modifiers_str = ' '.join(self.details.access_modifiers) + (' ' if len(self.details.access_modifiers) > 0 else '')
-        return f".method {access_modifiers_str}{self.details.name}({self.details.parameters}){self.details.return_type}"
+        access_modifiers_str = ' '.join(self.access_modifiers) + (' ' if len(self.access_modifiers) > 0 else '')
+        return f".method {access_modifiers_str}{self.name}({self.parameters}){self.return_type}"
 
     def __str__(self):
+        if not self.dirty and self.span is not None:
+            return self.parent.source[self.span[0]:self.span[1]]
+        if self.body_lines is not None:
+            return self.str_from_body_lines()
         locals_str = f"    .locals {self.locals}\n" if self.locals is not None else ""
-        instructions_str = '\n'.join(str(instr) for instr in self.iterate_instructions())
+        instructions_str = '\n'.join(str(instr) for instr in self.instructions[1:-1])
         second_break = '\n' if len(instructions_str) + len(locals_str) > 0 else ''
         method_str = f"{self.construct_header()}\n{locals_str}{instructions_str}{second_break}.end method"
         return method_str
 
+    def str_from_body_lines(self):
+        locals = None
+        instruction_lines = []
+        for line in self.body_lines:
+            stripped = line.strip()
+            if not stripped:
+                continue
+            if stripped.startswith('.locals'):
+                locals = int(LOCALS_PATTERN.search(line).group(1))
+            else:
+                indent = max(len(line) - len(line.lstrip()), 4)
+                instruction_lines.append(' ' * indent + stripped)
+        locals_str = f"    .locals {locals}\n" if locals is not None else ""
+        instructions_str = '\n'.join(instruction_lines)
+        second_break = '\n' if len(instructions_str) + len(locals_str) > 0 else ''
+        return f"{self.construct_header()}\n{locals_str}{instructions_str}{second_break}.end method"
+
     def iterate_instructions(self):
+        instructions = self.instructions
+        position = 1
+        while position < len(instructions) - 1:
+            instruction = instructions[position]
+            yield instruction
+            position = instruction.resume_position()
+
+    def renumber(self):
+        instructions = self.instructions
+        for position in range(self.stale_from, len(instructions)):
+            instructions[position]._position = position
+        self.stale_from = len(instructions)
+
+    def insert_at(self, position: int, instruction: 'SmaliInstruction'):
+        self.instructions.insert(position, instruction)
+        instruction._position = position
+        if position < self.stale_from:
+            self.stale_from = position
+        self.instruction_inserted(instruction)
+
+    def for_instruction(self, instruction_details: InstructionDetails, action: Callable[['SmaliInstruction'], None], limit: Optional[int] = None) -> int:
+        # Runs action on at most limit instructions and returns how many it ran on.
+        predicate = compile_filter(instruction_details)
+        if isinstance(predicate, SequenceAutomaton):
+            return self.for_sequence(predicate, action, limit)
+        count = 0
+        if limit == 0:
+            return count
+        index_key = getattr(predicate, 'index_key', None)
+        if self.index is None and index_key is not None:
+            self.searches += 1
+            if self.searches < INDEX_AFTER_SEARCHES:
+                index_key = None
+        if index_key is None:
+            for instruction in self.iterate_instructions():
+                if predicate(instruction):
+                    self.mark_dirty()
+                    action(instruction)
+                    count += 1
+                    if count == limit:
+                        break
+            return count
+
+        candidates = self.get_index().candidates(*index_key)
+        position = 0
+        while position < len(candidates):
+            instruction = candidates[position]
+            if predicate(instruction):
+                self.mark_dirty()
+                action(instruction)
+                count += 1
+                if count == limit:
+                    break
+            position = bisect.bisect_left(candidates, instruction.resume_position(), key=instruction_position)
+        return count
+
+    def for_sequence(self, pattern: SequencePattern, action: Callable[[SequenceMatch], None], limit: Optional[int] = None) -> int:
+        # All matches are found before the first action runs, so instructions inserted by an
+        # action are not matched again.
+        automaton = compile_filter(pattern)
+        count = 0
+        if limit == 0:
+            return count
+        for match in automaton.find(self):
+            if any(instruction.position is None for instruction in match):
+                continue
+            self.mark_dirty()
+            action(match)
+            count += 1
+            if count == limit:
+                break
+        return count
+
+    def get_index(self) -> 'InstructionIndex':
+        if self.index is None:
+            self.index = InstructionIndex(self)
+        return self.index
+
+    def get_flow(self) -> 'ControlFlowGraph':
+        if self.flow is None:
+            self.flow = ControlFlowGraph(self)
+        return self.flow
+
+    def get_liveness(self) -> 'Liveness':
+        if self.liveness is None:
+            self.liveness = Liveness(self)
+        return self.liveness
+
+    def find_label(self, label: str) -> Optional['SmaliInstruction']:
+        return self.get_flow().labels.get(label)
+
+    def new_label(self, prefix: str) -> str:
+        # Numbered within the method only, so the label does not depend on what else was
+        # patched before or in which process.
+        if self.issued_labels is None:
+            self.issued_labels = set()
+        labels = {instruction.original_line for instruction in self.iterate_instructions() if instruction.original_line.startswith(':')}
+        number = 0
+        while f':{prefix}_{number}' in labels or f':{prefix}_{number}' in self.issued_labels:
+            number += 1
+        label = f':{prefix}_{number}'
+        self.issued_labels.add(label)
+        return label
+
+    def instruction_inserted(self, instruction: 'SmaliInstruction'):
+        self.mark_dirty()
+        if self.flow is not None and self.flow.insert(instruction):
+            if self.liveness is not None and not self.liveness.insert(instruction):
+                self.liveness = None
+        else:
+            self.drop_flow()
+        if self.index is not None:
+            self.index.add(instruction)
+
+    def instruction_replaced(self, instruction: 'SmaliInstruction', replacement: 'SmaliInstruction'):
+        self.mark_dirty()
+        self.drop_flow()
+        if self.index is not None:
+            self.index.remove(instruction)
+            self.index.add(replacement)
+
+    def instruction_removed(self, instruction: 'SmaliInstruction'):
+        self.mark_dirty()
+        self.drop_flow()
+        if self.index is not None:
+            self.index.remove(instruction)
+
+    def drop_flow(self):
+        self.flow = None
+        self.liveness = None
+
+    def for_instructions(self, patches: List[tuple]):
+        # Walks the method once for several (predicate, action) pairs while keeping the
+        # visiting order of running them one after another: an action's insertions after
+        # the current instruction are visited by that patch and the following ones, while
+        # insertions before it or replacements are only visited by the following patches.
+        original = set(self.iterate_instructions())
+        original.add(self.first_instruction)
+        original.add(self.last_instruction)
+        first_patch = {}
+        visited = set()
+
+        def is_new(instruction):
+            return instruction is not None and instruction not in original and instruction not in first_patch
+
+        def visit(instruction, start):
+            visited.add(instruction)
+            for index in range(start, len(patches)):
+                if instruction.prev is None or instruction.prev.next is not instruction:
+                    return
+                predicate, action = patches[index]
+                if not predicate(instruction):
+                    continue
+                self.mark_dirty()
+                action(instruction)
+
+                inserted_after = instruction.next
+                while is_new(inserted_after):
+                    first_patch[inserted_after] = index
+                    inserted_after = inserted_after.next
+
+                if instruction.prev.next is instruction:
+                    inserted_before = instruction.prev
+                else:
+                    inserted_before = inserted_after.prev if inserted_after is not None else None
+                new_instruction = None
+                while is_new(inserted_before):
+                    first_patch[inserted_before] = index + 1
+                    new_instruction = inserted_before
+                    inserted_before = inserted_before.prev
+                while new_instruction is not None and new_instruction is not instruction and new_instruction not in original:
+                    if new_instruction not in visited:
+                        visit(new_instruction, first_patch[new_instruction])
+                    new_instruction = new_instruction.next
+
         current = self.first_instruction.next
-        while current != self.last_instruction:
-            yield current
+        while current is not None and current is not self.last_instruction:
+            if current not in visited:
+                visit(current, first_patch.get(current, 0))
             current = current.next
 
-    def for_instruction(self, instruction_details: InstructionDetails, action: Callable[['SmaliInstruction'], None]):
-        for instruction in self.iterate_instructions():
-            if instruction.matches(instruction_details):
-                action(instruction)
 
+DECODED_FIELDS = (
+    '_operands', '_instruction_type', '_modifier', '_class_name', '_field_name', '_data_type', '_registers',
+    '_method', '_param_types', '_return_type', '_label', '_constant_value',
+)
+
+def decoded_field(slot: str, editable: bool = True) -> property:
+    # The rest of the line is decoded before a field is written, since a decoded
+    # instruction is printed from its fields rather than from original_line, and the
+    # method is marked dirty so that it is not written out as its original text.
+    def get(self):
+        if not self.decoded:
+            self.decode()
+        return getattr(self, slot)
+
+    def set(self, value):
+        if not self.decoded:
+            self.decode()
+        setattr(self, slot, value)
+        if self.parent is not None:
+            self.parent.mark_dirty()
+
+    return property(get, set if editable else None)
 
 class SmaliInstruction(SmaliPiece):
+    __slots__ = (
+        '_position', 'detached_prev', 'detached_next', 'indent', 'original_line', 'parent', 'operation', 'decoded',
+    ) + DECODED_FIELDS
+
     def __init__(self, line: str, parent: 'SmaliMethod'):
-        self.prev: Optional['SmaliInstruction'] = None
-        self.next: Optional['SmaliInstruction'] = None
+        self._position: Optional[int] = None
+        self.detached_prev: Optional['SmaliInstruction'] = None
+        self.detached_next: Optional['SmaliInstruction'] = None
         self.indent = len(line) - len(line.lstrip())
-        self.visited = False
         if self.indent < 4:
             self.indent = 4
         self.original_line: str = line.strip()
         self.parent = parent
-        self.details: InstructionDetails = InstructionDetails()
         self.operation: str = ''
-        self.operands: str = ''
-        self.parse_instruction()
+        if self.original_line and self.original_line[0] != ':':
+            self.operation = self.original_line.split(maxsplit=1)[0]
+        self.decoded = False
+
+    operands = decoded_field('_operands', editable = False)
+    instruction_type = decoded_field('_instruction_type')
+    modifier = decoded_field('_modifier')
+    data_type = decoded_field('_data_type')
+    param_types = decoded_field('_param_types')
+    return_type = decoded_field('_return_type')
+    label = decoded_field('_label')
+    constant_value = decoded_field('_constant_value')
+
+    def decode(self):
+        if not self.decoded:
+            self.decoded = True
+            self.parse_instruction()
+        return self
+
+    def _set_details(
+        self,
+        instruction_type: InstructionType,
+        modifier: Optional[str] = None,
+        class_name: Optional[str] = None,
+        field_name: Optional[str] = None,
+        data_type: Optional[str] = None,
+        registers: Optional[List['Register']] = None,
+        method: Optional[str] = None,
+        param_types: Optional[str] = None,
+        return_type: Optional[str] = None,
+        label: Optional[str] = None,
+        constant_value: Optional[str] = None,
+    ):
+        self._instruction_type = instruction_type
+        self._modifier = modifier
+        self._class_name = class_name
+        self._field_name = field_name
+        self._data_type = data_type
+        self._registers = RegisterList(registers, self) if registers is not None else None
+        self._method = method
+        self._param_types = param_types
+        self._return_type = return_type
+        self._label = label
+        self._constant_value = constant_value
+
+    @property
+    def class_name(self) -> Optional[str]:
+        if not self.decoded:
+            self.decode()
+        return self._class_name
+
+    @class_name.setter
+    def class_name(self, value: Optional[str]):
+        self.set_reference('_class_name', value)
+
+    @property
+    def field_name(self) -> Optional[str]:
+        if not self.decoded:
+            self.decode()
+        return self._field_name
+
+    @field_name.setter
+    def field_name(self, value: Optional[str]):
+        self.set_reference('_field_name', value)
+
+    @property
+    def method(self) -> Optional[str]:
+        if not self.decoded:
+            self.decode()
+        return self._method
+
+    @method.setter
+    def method(self, value: Optional[str]):
+        self.set_reference('_method', value)
+
+    @property
+    def registers(self) -> Optional['RegisterList']:
+        if not self.decoded:
+            self.decode()
+        return self._registers
+
+    @registers.setter
+    def registers(self, value: Optional[List['Register']]):
+        self.decode()
+        self._registers = RegisterList(value, self) if value is not None else None
+        self.registers_changed()
+
+    def registers_changed(self):
+        if self.parent is not None:
+            self.parent.liveness = None
+            self.parent.mark_dirty()
+
+    def set_reference(self, name: str, value: Optional[str]):
+        self.decode()
+        if self.parent is not None:
+            value = self.parent.parent.workspace.intern(value)
+            self.parent.mark_dirty()
+        index = self.parent.index if self.parent is not None else None
+        if index is not None and index.remove(self):
+            setattr(self, name, value)
+            index.add(self)
+        else:
+            setattr(self, name, value)
+
+    @property
+    def details(self) -> InstructionDetails:
+        return InstructionDetails(
+            instruction_type = self.instruction_type,
+            modifier = self.modifier,
+            class_name = self.class_name,
+            field_name = self.field_name,
+            data_type = self.data_type,
+            registers = self.registers,
+            method = self.method,
+            param_types = self.param_types,
+            return_type = self.return_type,
+            label = self.label,
+            constant_value = self.constant_value,
+        )
+
+    def may_be(self, instruction_types: frozenset) -> bool:
+        if self.decoded:
+            return self.instruction_type in instruction_types
+        if not self.original_line:
+            return InstructionType.EMPTY in instruction_types
+        if self.original_line[0] == ':':
+            return InstructionType.LABEL in instruction_types
+        return lookup_opcode(self.operation).instruction_type in instruction_types
+
+    @property
+    def position(self) -> Optional[int]:
+        if self._position is not None and self._position >= self.parent.stale_from:
+            self.parent.renumber()
+        return self._position
+
+    @property
+    def prev(self) -> Optional['SmaliInstruction']:
+        position = self.position
+        if position is None:
+            return self.detached_prev
+        return self.parent.instructions[position - 1] if position > 0 else None
+
+    @property
+    def next(self) -> Optional['SmaliInstruction']:
+        position = self.position
+        if position is None:
+            return self.detached_next
+        instructions = self.parent.instructions
+        return instructions[position + 1] if position + 1 < len(instructions) else None
+
+    def resume_position(self) -> int:
+        # Position of the first instruction not yet visited by a walk currently at this one,
+        # following the neighbours it had when it was removed.
+        instruction = self
+        while instruction._position is None:
+            instruction = instruction.detached_next
+        return instruction.position + 1 if instruction is self else instruction.position
+
+    def detach(self, prev: 'SmaliInstruction', next: 'SmaliInstruction'):
+        self._position = None
+        self.detached_prev = prev
+        self.detached_next = next
 
     def expand_after(self, instruction_list):
         for instruction in instruction_list[::-1]:
@@ -509,16 +2624,12 @@ class SmaliInstruction(SmaliPiece):
             if len(instruction.strip()) == 0:
                 return
             instruction = SmaliInstruction(instruction, self.parent)
-        instruction.next = self.next
-        instruction.prev = self
-        if self.next:
-            self.next.prev = instruction
-        self.next = instruction
+        self.parent.insert_at(self.position + 1, instruction)
 
     def next_known(self):
         next_instruction = self.next
         while next_instruction is not None:
-            if next_instruction.details.instruction_type not in [InstructionType.UNKNOWN, InstructionType.EMPTY]:
+            if next_instruction.instruction_type not in [InstructionType.UNKNOWN, InstructionType.EMPTY]:
                 return next_instruction
             next_instruction = next_instruction.next
         return None
@@ -526,7 +2637,7 @@ class SmaliInstruction(SmaliPiece):
     def prev_known(self):
         prev_instruction = self.prev
         while prev_instruction is not None:
-            if prev_instruction.details.instruction_type not in [InstructionType.UNKNOWN, InstructionType.EMPTY]:
+            if prev_instruction.instruction_type not in [InstructionType.UNKNOWN, InstructionType.EMPTY]:
                 return prev_instruction
             prev_instruction = prev_instruction.prev
         return None
@@ -540,18 +2651,20 @@ class SmaliInstruction(SmaliPiece):
             if len(instruction.strip()) == 0:
                 return
             instruction = SmaliInstruction(instruction, self.parent)
-        instruction.prev = self.prev
-        instruction.next = self
-        if self.prev:
-            self.prev.next = instruction
-        self.prev = instruction
+        self.parent.insert_at(self.position, instruction)
 
     def remove(self):
-        if self.prev:
-            self.prev.next = self.next
-        if self.next:
-            self.next.prev = self.prev
-        return self.next
+        position = self.position
+        if position is None:
+            return self.detached_next
+        method = self.parent
+        instructions = method.instructions
+        method.instruction_removed(self)
+        self.detach(instructions[position - 1], instructions[position + 1])
+        del instructions[position]
+        if position < method.stale_from:
+            method.stale_from = position
+        return self.detached_next
 
     def replace_multiple(self, instruction_list):
         self.expand_after(instruction_list)
@@ -563,335 +2676,639 @@ class SmaliInstruction(SmaliPiece):
                 self.remove()
                 return
             instruction = SmaliInstruction(instruction, self.parent)
-        instruction.prev = self.prev
-        instruction.next = self.next
-        if self.prev:
-            self.prev.next = instruction
-        if self.next:
-            self.next.prev = instruction
+        position = self.position
+        instructions = self.parent.instructions
+        instructions[position] = instruction
+        instruction._position = position
+        self.parent.instruction_replaced(self, instruction)
+        self.detach(instructions[position - 1], instructions[position + 1])
 
     def parse_instruction(self):
+        self._operands = ''
         if not self.original_line:
-            self.details = InstructionDetails(
-                instruction_type=InstructionType.EMPTY,
-            )
+            self._set_details(InstructionType.EMPTY)
             return
 
         if self.original_line.startswith(':'):
-            self.details = InstructionDetails(
-                instruction_type=InstructionType.LABEL,
+            self._set_details(
+                InstructionType.LABEL,
                 label=self.original_line
             )
             return
 
         parts = self.original_line.split(maxsplit=1)
-        self.operation = parts[0].strip()
-        self.operands = parts[1].strip() if len(parts) > 1 else ''
+        self._operands = parts[1].strip() if len(parts) > 1 else ''
         self.classify_instruction()
 
     def classify_instruction(self):
-        if self.operation.startswith(('iget', 'iput', 'sget', 'sput')):
-            self.extract_field_access()
-        elif self.operation.startswith('invoke'):
-            self.extract_method_invoke()
-        elif self.operation.startswith('const'):
-            self.extract_constant()
-        elif self.operation.startswith('new-array'):
-            self.extract_new_array()
-        elif self.operation.startswith('new-instance'):
-            self.extract_new_instance()
-        elif self.operation.startswith(('goto', 'if-')):
-            self.extract_branch_or_condition()
-        elif self.operation.startswith('move-result'):
-            self.extract_move_result()
-        elif self.operation.startswith('move'):
-            self.extract_move()
-        elif self.operation.startswith('return'):
-            self.extract_return()
-        else:
+        opcode = lookup_opcode(self.operation)
+        if opcode.pattern is None:
             self.extract_unknown()
-
-    def extract_return(self):
-        match = re.match(r'^(?P<op>\S+)\s*(?P<reg>[pv]\d+)?', self.original_line)
+            return
+        match = opcode.pattern.match(self.original_line)
         if match:
-            op = match.group('op')
-            self.details = InstructionDetails(
-                instruction_type=InstructionType.RETURN,
-                modifier=op[6:],
-                registers=[match.group('reg')] if match.group('reg') else [],
-            )
+            opcode.extract(self, opcode, match)
         else:
-            logging.warning(f'Unrecognised return pattern: {self.original_line}')
+            logging.warning(f'Unrecognised {opcode.description} pattern: {self.original_line}')
             self.extract_unknown()
 
-    def extract_move_result(self):
-        match = re.match(r'^(?P<op>\S+)\s+(?P<reg>[pv]\d+)', self.original_line)
-        if match:
-            op = match.group('op')
-            self.details = InstructionDetails(
-                instruction_type=InstructionType.MOVE_RESULT,
-                modifier=op[11:],
-                registers=[match.group('reg')],
-            )
-        else:
-            logging.warning(f'Unrecognised move-result pattern: {self.original_line}')
-            self.extract_unknown()
+    def extract_return(self, opcode: 'Opcode', match: re.Match):
+        register = match.group('reg')
+        self._set_details(
+            opcode.instruction_type,
+            modifier=opcode.modifier,
+            registers=[parse_register(register)] if register else [],
+        )
 
-    def extract_move(self):
-        match = re.match(r'^(?P<op>\S+)\s+(?P<regs>([pv]\d+,?\s*)+)', self.original_line)
-        if match:
-            op = match.group('op')
-            registers = [r.strip() for r in match.group('regs').strip(' \t\f,').split(',')]
-            self.details = InstructionDetails(
-                instruction_type=InstructionType.MOVE,
-                modifier=op[4:],
-                registers=registers,
-            )
-        else:
-            logging.warning(f'Unrecognised move pattern: {self.original_line}')
-            self.extract_unknown()
+    def extract_move_result(self, opcode: 'Opcode', match: re.Match):
+        self._set_details(
+            opcode.instruction_type,
+            modifier=opcode.modifier,
+            registers=[parse_register(match.group('reg'))],
+        )
 
-    def extract_field_access(self):
-        match = re.match(r'^(?P<op>\S+)\s+(?P<regs>([pv]\d+,\s*)+)\s+(?P<class>\S+)->(?P<field>[^\s\:]+):(?P<type>\S+)', self.original_line)
-        if match:
-            op = match.group('op')
-            instruction_type = InstructionType.FIELD_WRITE if 'put' in op else InstructionType.FIELD_READ
-            registers = [r.strip() for r in match.group('regs').strip(' \t\f,').split(',')]
-            self.details = InstructionDetails(
-                instruction_type=instruction_type,
-                modifier=op[4:],
-                registers=registers,
-                class_name=match.group('class'),
-                field_name=match.group('field'),
-                data_type=match.group('type'),
-            )
-        else:
-            logging.warning(f'Unrecognised field access pattern: {self.original_line}')
-            self.extract_unknown()
+    def extract_move(self, opcode: 'Opcode', match: re.Match):
+        self._set_details(
+            opcode.instruction_type,
+            modifier=opcode.modifier,
+            registers=split_registers(match.group('regs')),
+        )
 
-    def extract_method_invoke(self):
-        match = re.match(r'^(?P<op>\S+)\s+\{(?P<regs>[^}]*)\},\s+(?P<class>\S+)->(?P<method>\S+)\((?P<params>[^)]*)\)(?P<ret>\S+)\s*$', self.original_line)
-        if match:
-            registers = [r.strip() for r in match.group('regs').strip(' \t\f,').split(',')]
-            op = match.group('op')
-            self.details = InstructionDetails(
-                instruction_type=InstructionType.METHOD_INVOKE,
-                modifier=op[6:],
-                registers=registers,
-                class_name=match.group('class'),
-                method=match.group('method'),
-                param_types=match.group('params'),
-                return_type=match.group('ret')
-            )
-        else:
-            logging.warning(f'Unrecognised method invoke pattern: {self.original_line}')
-            self.extract_unknown()
+    def extract_field_access(self, opcode: 'Opcode', match: re.Match):
+        intern = self.parent.parent.workspace.intern
+        self._set_details(
+            opcode.instruction_type,
+            modifier=opcode.modifier,
+            registers=split_registers(match.group('regs')),
+            class_name=intern(match.group('class')),
+            field_name=intern(match.group('field')),
+            data_type=intern(match.group('type')),
+        )
 
-    def extract_constant(self):
-        match = re.match(r'^(?P<op>\S+)\s+(?P<reg>[pv]\d+),\s+(?P<value>.+)', self.original_line)
-        if match:
-            op = match.group('op')
-            self.details = InstructionDetails(
-                instruction_type=InstructionType.CONSTANT,
-                modifier=op[5:],
-                registers=[match.group('reg')],
-                constant_value=match.group('value')
-            )
-        else:
-            logging.warning(f'Unrecognised constant pattern: {self.original_line}')
-            self.extract_unknown()
+    def extract_method_invoke(self, opcode: 'Opcode', match: re.Match):
+        intern = self.parent.parent.workspace.intern
+        self._set_details(
+            opcode.instruction_type,
+            modifier=opcode.modifier,
+            registers=split_registers(match.group('regs')),
+            class_name=intern(match.group('class')),
+            method=intern(match.group('method')),
+            param_types=intern(match.group('params')),
+            return_type=intern(match.group('ret'))
+        )
 
-    def extract_new_array(self):
-        match = re.match(r'^(\S+)\s+(?P<regs>\w+),\s+(?P<size_reg>\w+),\s+(?P<array_type>\[\S+)', self.original_line)
-        if match:
-            registers = [match.group('regs')]
-            registers.append(match.group('size_reg'))
-            self.details = InstructionDetails(
-                instruction_type=InstructionType.NEW_ARRAY,
-                registers=registers,
-                data_type=match.group('array_type')
-            )
-        else:
-            logging.warning(f'Unrecognised new array pattern: {self.original_line}')
-            self.extract_unknown()
+    def extract_constant(self, opcode: 'Opcode', match: re.Match):
+        self._set_details(
+            opcode.instruction_type,
+            modifier=opcode.modifier,
+            registers=[parse_register(match.group('reg'))],
+            constant_value=match.group('value')
+        )
 
-    def extract_new_instance(self):
-        match = re.match(r'^(new-instance)\s+(?P<reg>\w+),\s+(?P<class>\S+)', self.original_line)
-        if match:
-            self.details = InstructionDetails(
-                instruction_type=InstructionType.NEW_INSTANCE,
-                registers=[match.group('reg')],
-                class_name=match.group('class')
-            )
-        else:
-            logging.warning(f'Unrecognised new instance pattern: {self.original_line}')
-            self.extract_unknown()
+    def extract_new_array(self, opcode: 'Opcode', match: re.Match):
+        self._set_details(
+            opcode.instruction_type,
+            registers=[parse_register(match.group('regs')), parse_register(match.group('size_reg'))],
+            data_type=self.parent.parent.workspace.intern(match.group('array_type'))
+        )
 
-    def extract_branch_or_condition(self):
-        match = re.match(r'^(?P<op>\S+)\s+(?P<regs>([pv]\d+,\s*)+)?\s*(?P<label>:\S+)', self.original_line)
-        if match:
-            if match.group('regs'):
-                registers = [r.strip() for r in match.group('regs').strip(' \t\f,').split(',')]
-            else:
-                registers = []
-            self.details = InstructionDetails(
-                instruction_type=InstructionType.BRANCH,
-                registers=registers,
-                label=match.group('label')
-            )
-        else:
-            logging.warning(f'Unrecognised branch or condition pattern: {self.original_line}')
-            self.extract_unknown()
+    def extract_new_instance(self, opcode: 'Opcode', match: re.Match):
+        self._set_details(
+            opcode.instruction_type,
+            registers=[parse_register(match.group('reg'))],
+            class_name=self.parent.parent.workspace.intern(match.group('class'))
+        )
+
+    def extract_branch_or_condition(self, opcode: 'Opcode', match: re.Match):
+        registers = match.group('regs')
+        self._set_details(
+            opcode.instruction_type,
+            registers=split_registers(registers) if registers else [],
+            label=match.group('label')
+        )
 
     def extract_unknown(self):
-        self.details = InstructionDetails(
-            instruction_type=InstructionType.UNKNOWN,
-            registers=re.findall(r'[{\s,]([pv]\d+)[,}\s]', f" {self.original_line} "),
+        self._set_details(
+            InstructionType.UNKNOWN,
+            registers=parse_unknown_registers(self.original_line),
         )
 
     def _find_target(self):
-        if self.details.instruction_type != InstructionType.BRANCH:
+        if self.instruction_type != InstructionType.BRANCH:
             return None
-
-        current_instruction = self
-        while current_instruction is not None:
-            if current_instruction.details.instruction_type == InstructionType.LABEL and current_instruction.details.label == self.details.label:
-                return current_instruction
-            current_instruction = current_instruction.next
-
-        current_instruction = self.prev
-        while current_instruction is not None:
-            if current_instruction.details.instruction_type == InstructionType.LABEL and current_instruction.details.label == self.details.label:
-                return current_instruction
-            current_instruction = current_instruction.prev
-
-        return None
-
-    def _find_unsafe_registers(self, is_conditional = False):
-        if self.visited:
-            return set(), set()
-
-        safe_registers = set()
-        unsafe_registers = set()
-        current_instruction = self
-
-        while current_instruction is not None and not current_instruction.visited:
-            current_instruction.visited = True
-            if not is_conditional \
-               and current_instruction.details.registers is not None \
-               and current_instruction.details.instruction_type in {
-                InstructionType.FIELD_READ,
-                InstructionType.CONSTANT,
-                InstructionType.NEW_INSTANCE,
-                InstructionType.NEW_ARRAY,
-                InstructionType.MOVE,
-               }:
-                reg = current_instruction.details.registers[0]
-                if reg not in unsafe_registers:
-                    safe_registers.add(reg)
-
-            if current_instruction.details.registers is not None:
-                unsafe_registers.update(current_instruction.details.registers)
-
-            if current_instruction.details.instruction_type == InstructionType.BRANCH:
-                if current_instruction.registers and len(current_instruction.registers) > 0:
-                    is_conditional = True
-                    unsafe_registers.update(current_instruction._find_target()._find_unsafe_registers(is_conditional = True)[1])
-                else:
-                    current_instruction = current_instruction._find_target()
-                    continue
-
-            if current_instruction.instruction_type == InstructionType.RETURN:
-                break
-
-            current_instruction = current_instruction.next
-
-        return safe_registers, unsafe_registers.difference(safe_registers)
+        return self.parent.find_label(self.label)
 
     def get_n_free_registers(self, n):
-        current_instruction = self
-        while current_instruction is not None:
-            current_instruction.visited = False
-            current_instruction = current_instruction.next
-
-        current_instruction = self.prev
-        while current_instruction is not None:
-            current_instruction.visited = False
-            current_instruction = current_instruction.prev
-
+        live_registers = self.parent.get_liveness().live_at(self)
         free_registers = []
-        unsafe_registers = self._find_unsafe_registers()[1]
         for i in range(self.parent.locals + n + 2):
             if len(free_registers) >= n:
                 return free_registers
-            register = f'v{i}'
-            if register not in unsafe_registers:
-                free_registers.append(register)
+            if not live_registers & Register.v(i).bit:
+                free_registers.append(Register.v(i))
                 if i >= self.parent.locals:
                     self.parent.locals = i + 1
+                    self.parent.mark_dirty()
 
     def __str__(self):
+        if not self.decoded:
+            return (' ' * self.indent) + self.original_line if self.original_line else ''
         from_type = self.str_from_type()
         if len(from_type) == 0:
             return ''
         return (' ' * self.indent) + from_type
 
     def str_from_type(self):
-        if self.details.instruction_type.matches([InstructionType.FIELD_WRITE, InstructionType.FIELD_READ]):
-            op = self.operation[0] + ("put" if self.details.instruction_type == InstructionType.FIELD_WRITE else "get")
-            return f"{op}{self.details.modifier} {', '.join(self.details.registers)}, {self.details.class_name}->{self.details.field_name}:{self.details.data_type}"
-        elif self.details.instruction_type.matches(InstructionType.METHOD_INVOKE):
-            registers = ', '.join(self.details.registers)
-            return f"invoke{self.details.modifier} {{{registers}}}, {self.details.class_name}->{self.details.method}({self.details.param_types}){self.details.return_type}"
-        elif self.details.instruction_type.matches(InstructionType.CONSTANT):
-            return f"const{self.details.modifier} {self.details.registers[0]}, {self.details.constant_value}"
-        elif self.details.instruction_type.matches(InstructionType.NEW_ARRAY):
-            return f"{self.operation} {self.details.registers[0]}, {self.details.registers[1]}, {self.details.data_type}"
-        elif self.details.instruction_type.matches(InstructionType.NEW_INSTANCE):
-            return f"{self.operation} {self.details.registers[0]}, {self.details.class_name}"
-        elif self.details.instruction_type.matches(InstructionType.BRANCH):
-            registers = ', '.join(self.details.registers) + (', ' if self.details.registers and len(self.details.registers) > 0 else '')
-            return f"{self.operation} {registers}{self.details.label}"
-        elif self.details.instruction_type.matches(InstructionType.LABEL):
-            return self.details.label
-        elif self.details.instruction_type.matches(InstructionType.MOVE_RESULT):
-            return f"move-result{self.details.modifier} {self.details.registers[0]}"
-        elif self.details.instruction_type.matches(InstructionType.MOVE):
-            registers = ', '.join(self.details.registers)
-            return f"move{self.details.modifier} {registers}"
-        elif self.details.instruction_type.matches(InstructionType.RETURN):
-            registers = '' if len(self.details.registers) == 0 else f' {self.details.registers[0]}'
-            return f"return{self.details.modifier}{registers}"
+        if self.instruction_type.matches([InstructionType.FIELD_WRITE, InstructionType.FIELD_READ]):
+            op = self.operation[0] + ("put" if self.instruction_type == InstructionType.FIELD_WRITE else "get")
+            return f"{op}{self.modifier} {join_registers(self.registers)}, {self.class_name}->{self.field_name}:{self.data_type}"
+        elif self.instruction_type.matches(InstructionType.METHOD_INVOKE):
+            if self.modifier.endswith('/range') and len(self.registers) > 0:
+                registers = f'{self.registers[0]} .. {self.registers[-1]}'
+            else:
+                registers = join_registers(self.registers)
+            return f"invoke{self.modifier} {{{registers}}}, {self.class_name}->{self.method}({self.param_types}){self.return_type}"
+        elif self.instruction_type.matches(InstructionType.CONSTANT):
+            return f"const{self.modifier} {self.registers[0]}, {self.constant_value}"
+        elif self.instruction_type.matches(InstructionType.NEW_ARRAY):
+            return f"{self.operation} {self.registers[0]}, {self.registers[1]}, {self.data_type}"
+        elif self.instruction_type.matches(InstructionType.NEW_INSTANCE):
+            return f"{self.operation} {self.registers[0]}, {self.class_name}"
+        elif self.instruction_type.matches(InstructionType.BRANCH):
+            registers = join_registers(self.registers) + (', ' if self.registers and len(self.registers) > 0 else '')
+            return f"{self.operation} {registers}{self.label}"
+        elif self.instruction_type.matches(InstructionType.LABEL):
+            return self.label
+        elif self.instruction_type.matches(InstructionType.MOVE_RESULT):
+            return f"move-result{self.modifier} {self.registers[0]}"
+        elif self.instruction_type.matches(InstructionType.MOVE):
+            return f"move{self.modifier} {join_registers(self.registers)}"
+        elif self.instruction_type.matches(InstructionType.RETURN):
+            registers = '' if len(self.registers) == 0 else f' {self.registers[0]}'
+            return f"return{self.modifier}{registers}"
         return self.original_line
 
-    def matches(self, search_details: InstructionDetails) -> bool:
-        return search_details.matches(self.details)
+class Register(int):
+    __slots__ = ()
 
-class SmaliField(SmaliPiece):
-    def __init__(self, line: str, parent: Any):
-        match = re.match(r'\.field\s+(?P<modifiers>([^\s:="]+[\t \f]+)*)(?P<name>[^\s:="]+):(?P<type>[^\s=]+)(\s*=\s*(?P<value>[^\n]+))?[ \t\f]*$', line)
-        if match:
-            self.line = None
-            self.details = FieldDetails(
-                name = match.group('name'),
-                type = match.group('type'),
-                modifiers = list(map(str.strip, match.group('modifiers').strip().split())),
-                value = match.group('value').strip() if match.group('value') is not None else None
+    @staticmethod
+    def v(index: int) -> 'Register':
+        return Register(index * 2 + REGISTER_V)
+
+    @staticmethod
+    def p(index: int) -> 'Register':
+        return Register(index * 2 + REGISTER_P)
+
+    @property
+    def kind(self) -> int:
+        return self & 1
+
+    @property
+    def index(self) -> int:
+        return self >> 1
+
+    @property
+    def bit(self) -> int:
+        return 1 << self
+
+    def __str__(self):
+        return f"{'p' if self & 1 else 'v'}{self >> 1}"
+
+    def __format__(self, format_spec: str):
+        return format(str(self), format_spec)
+
+    def __repr__(self):
+        return self.__str__()
+
+class RegisterList(list):
+    __slots__ = ('owner',)
+
+    def __init__(self, registers: List[Any] = (), owner: Optional['SmaliInstruction'] = None):
+        super().__init__(map(as_register, registers))
+        self.owner = owner
+
+    def changed(self):
+        if self.owner is not None:
+            self.owner.registers_changed()
+
+    def __setitem__(self, key, value):
+        if isinstance(key, slice):
+            value = map(as_register, value)
+        else:
+            value = as_register(value)
+        super().__setitem__(key, value)
+        self.changed()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.changed()
+
+    def __iadd__(self, registers):
+        self.extend(registers)
+        return self
+
+    def append(self, register):
+        super().append(as_register(register))
+        self.changed()
+
+    def extend(self, registers):
+        super().extend(map(as_register, registers))
+        self.changed()
+
+    def insert(self, position, register):
+        super().insert(position, as_register(register))
+        self.changed()
+
+    def pop(self, position = -1):
+        register = super().pop(position)
+        self.changed()
+        return register
+
+    def remove(self, register):
+        super().remove(as_register(register))
+        self.changed()
+
+    def clear(self):
+        super().clear()
+        self.changed()
+
+    def __str__(self):
+        # The list of names that a REGEX on registers has always been matched against.
+        return str([str(register) for register in self])
+
+REGISTERS = {}
+
+def as_register(register: Any) -> Register:
+    if isinstance(register, Register):
+        return register
+    if isinstance(register, str):
+        return parse_register(register.strip())
+    return Register(register)
+
+def parse_register(name: str) -> Register:
+    register = REGISTERS.get(name)
+    if register is None:
+        register = REGISTERS[name] = Register(int(name[1:]) * 2 + (REGISTER_P if name[0] == 'p' else REGISTER_V))
+    return register
+
+def parse_register_range(first: str, last: str) -> List[Register]:
+    first, last = parse_register(first), parse_register(last)
+    return [Register(register) for register in range(first, last + 1, 2)]
+
+def split_registers(registers: str) -> List[Register]:
+    registers = registers.strip(' \t\f,')
+    if not registers:
+        return []
+    if '..' in registers:
+        first, last = registers.split('..')
+        return parse_register_range(first.strip(), last.strip())
+    return [parse_register(r.strip()) for r in registers.split(',')]
+
+def parse_unknown_registers(line: str) -> List[Register]:
+    registers = UNKNOWN_REGISTERS_PATTERN.findall(f" {line} ")
+    if len(registers) == 2 and ' .. ' in line:
+        return parse_register_range(*registers)
+    return [parse_register(register) for register in registers]
+
+def join_registers(registers: List[Register]) -> str:
+    return ', '.join(map(str, registers))
+
+REGISTER_NAME_PATTERN = re.compile(r'[pv]\d+')
+TEMPLATE_REGISTER_BASE = 50000
+TEMPLATE_TEXT_FIELDS = (
+    '_operands', '_modifier', '_class_name', '_field_name', '_data_type', '_method', '_param_types', '_return_type',
+    '_label', '_constant_value',
+)
+TEMPLATE_INTERNED_FIELDS = ('_class_name', '_field_name', '_data_type', '_method', '_param_types', '_return_type')
+TEMPLATE_METHOD = None
+
+def template_method() -> 'SmaliMethod':
+    global TEMPLATE_METHOD
+    if TEMPLATE_METHOD is None:
+        TEMPLATE_METHOD = SmaliMethod('.method static template()V', SmaliClass(''))
+    return TEMPLATE_METHOD
+
+def placeholder_kind(value: Any) -> str:
+    if isinstance(value, Register) or (isinstance(value, str) and REGISTER_NAME_PATTERN.fullmatch(value)):
+        return 'register'
+    if isinstance(value, str) and value.startswith(':'):
+        return 'label'
+    return 'text'
+
+class TemplateLine:
+    __slots__ = ('line', 'prototype', 'registers', 'details')
+
+    def __init__(self, line: str, prototype: Optional['SmaliInstruction'] = None, registers: Optional[list] = None, details: tuple = ()):
+        self.line = line
+        self.prototype = prototype
+        self.registers = registers
+        self.details = details
+
+    def instantiate(self, parent: 'SmaliMethod', values: dict) -> 'SmaliInstruction':
+        instruction = SmaliInstruction(self.line.format(**values), parent)
+        if self.prototype is None:
+            return instruction
+        intern = parent.parent.workspace.intern
+        instruction.decoded = True
+        for field, value, formatted in self.details:
+            if formatted:
+                value = value.format(**values)
+                if field in TEMPLATE_INTERNED_FIELDS:
+                    value = intern(value)
+            setattr(instruction, field, value)
+        instruction._instruction_type = self.prototype.instruction_type
+        if self.registers is None:
+            instruction._registers = None
+        else:
+            instruction._registers = RegisterList(
+                [values[register] if isinstance(register, str) else register for register in self.registers], instruction
             )
+        return instruction
+
+class SmaliTemplate:
+    # Smali lines with str.format placeholders for registers, labels and descriptors, and
+    # {{ }} for the braces of register lists. Each line is parsed once per combination of
+    # placeholder kinds, with stand-in values. Lines that render back to their own text are
+    # instantiated as decoded copies with the real values put in directly; the others are
+    # formatted and parsed like any added line. Names in labels get a fresh label from the
+    # method when no value is given.
+    def __init__(self, lines: List[str], labels: List[str] = ()):
+        self.lines = [line for line in lines if len(line.strip()) > 0]
+        self.labels = tuple(labels)
+        self.compiled = {}
+
+    def instantiate(self, parent: 'SmaliMethod', **values) -> List['SmaliInstruction']:
+        for label in self.labels:
+            if label not in values:
+                values[label] = parent.new_label(label)
+        kinds = {name: placeholder_kind(value) for name, value in values.items()}
+        signature = tuple(sorted(kinds.items()))
+        compiled = self.compiled.get(signature)
+        if compiled is None:
+            compiled = self.compiled[signature] = [self.compile_line(line, kinds) for line in self.lines]
+        return [line.instantiate(parent, values) for line in compiled]
+
+    def compile_line(self, line: str, kinds: dict) -> TemplateLine:
+        sentinels = {}
+        sentinel_line = ''
+        for literal, field, format_spec, conversion in Formatter().parse(line):
+            sentinel_line += literal
+            if field is None:
+                continue
+            if format_spec or conversion or field not in kinds:
+                return TemplateLine(line)
+            sentinel = sentinels.get(field)
+            if sentinel is None:
+                number = len(sentinels)
+                if kinds[field] == 'register':
+                    sentinel = str(Register.v(TEMPLATE_REGISTER_BASE + number))
+                elif kinds[field] == 'label':
+                    sentinel = f':template_{number}_'
+                else:
+                    sentinel = f'template_{number}_'
+                sentinels[field] = sentinel
+            sentinel_line += sentinel
+
+        prototype = SmaliInstruction(sentinel_line, template_method()).decode()
+        if prototype.original_line.startswith(':'):
+            expected_type = InstructionType.LABEL
         else:
-            self.line = line
-            self.details = FieldDetails()
-        self.parent = parent
+            expected_type = lookup_opcode(prototype.operation).instruction_type
+        if prototype.instruction_type != expected_type or prototype.str_from_type() != prototype.original_line:
+            return TemplateLine(line)
+        if any(sentinel in prototype.operation for sentinel in sentinels.values()):
+            return TemplateLine(line)
+        register_names = {parse_register(sentinels[name]): name for name in sentinels if kinds[name] == 'register'}
+        if prototype.instruction_type == InstructionType.UNKNOWN and len(register_names) < len(sentinels):
+            return TemplateLine(line)
+        if prototype.modifier is not None and prototype.modifier.endswith('/range') and len(register_names) > 0:
+            return TemplateLine(line)
+
+        details = []
+        for field in TEMPLATE_TEXT_FIELDS:
+            value = getattr(prototype, field)
+            if isinstance(value, str) and any(sentinel in value for sentinel in sentinels.values()):
+                value = value.replace('{', '{{').replace('}', '}}')
+                for name, sentinel in sentinels.items():
+                    value = value.replace(sentinel, '{' + name + '}')
+                details.append((field, value, True))
+            else:
+                details.append((field, value, False))
+        registers = None
+        if prototype.registers is not None:
+            registers = [register_names.get(register, register) for register in prototype.registers]
+        return TemplateLine(line, prototype, registers, tuple(details))
+
+RETURN_PATTERN = re.compile(r'^(?P<op>\S+)\s*(?P<reg>[pv]\d+)?')
+MOVE_RESULT_PATTERN = re.compile(r'^(?P<op>\S+)\s+(?P<reg>[pv]\d+)')
+MOVE_PATTERN = re.compile(r'^(?P<op>\S+)\s+(?P<regs>([pv]\d+,?\s*)+)')
+FIELD_ACCESS_PATTERN = re.compile(r'^(?P<op>\S+)\s+(?P<regs>([pv]\d+,\s*)+)\s+(?P<class>\S+)->(?P<field>[^\s\:]+):(?P<type>\S+)')
+METHOD_INVOKE_PATTERN = re.compile(r'^(?P<op>\S+)\s+\{(?P<regs>[^}]*)\},\s+(?P<class>\S+)->(?P<method>\S+)\((?P<params>[^)]*)\)(?P<ret>\S+)\s*$')
+CONSTANT_PATTERN = re.compile(r'^(?P<op>\S+)\s+(?P<reg>[pv]\d+),\s+(?P<value>.+)')
+NEW_ARRAY_PATTERN = re.compile(r'^(\S+)\s+(?P<regs>\w+),\s+(?P<size_reg>\w+),\s+(?P<array_type>\[\S+)')
+NEW_INSTANCE_PATTERN = re.compile(r'^(new-instance)\s+(?P<reg>\w+),\s+(?P<class>\S+)')
+BRANCH_PATTERN = re.compile(r'^(?P<op>\S+)\s+(?P<regs>([pv]\d+,\s*)+)?\s*(?P<label>:\S+)')
+UNKNOWN_REGISTERS_PATTERN = re.compile(r'[{\s,]([pv]\d+)[,}\s]')
+
+@dataclass(frozen=True)
+class Opcode:
+    instruction_type: InstructionType
+    modifier: Optional[str] = None
+    pattern: Optional[re.Pattern] = None
+    extract: Optional[Callable] = None
+    description: str = ''
+
+    @staticmethod
+    def field_access(name: str):
+        instruction_type = InstructionType.FIELD_WRITE if 'put' in name else InstructionType.FIELD_READ
+        return Opcode(instruction_type, name[4:], FIELD_ACCESS_PATTERN, SmaliInstruction.extract_field_access, 'field access')
 
-    def matches(self, search_details: FieldDetails) -> bool:
-        return search_details.matches(self.details)
+    @staticmethod
+    def method_invoke(name: str):
+        return Opcode(InstructionType.METHOD_INVOKE, name[6:], METHOD_INVOKE_PATTERN, SmaliInstruction.extract_method_invoke, 'method invoke')
+
+    @staticmethod
+    def constant(name: str):
+        return Opcode(InstructionType.CONSTANT, name[5:], CONSTANT_PATTERN, SmaliInstruction.extract_constant, 'constant')
+
+    @staticmethod
+    def new_array(name: str):
+        return Opcode(InstructionType.NEW_ARRAY, None, NEW_ARRAY_PATTERN, SmaliInstruction.extract_new_array, 'new array')
+
+    @staticmethod
+    def new_instance(name: str):
+        return Opcode(InstructionType.NEW_INSTANCE, None, NEW_INSTANCE_PATTERN, SmaliInstruction.extract_new_instance, 'new instance')
+
+    @staticmethod
+    def branch(name: str):
+        return Opcode(InstructionType.BRANCH, None, BRANCH_PATTERN, SmaliInstruction.extract_branch_or_condition, 'branch or condition')
+
+    @staticmethod
+    def move_result(name: str):
+        return Opcode(InstructionType.MOVE_RESULT, name[11:], MOVE_RESULT_PATTERN, SmaliInstruction.extract_move_result, 'move-result')
+
+    @staticmethod
+    def move(name: str):
+        return Opcode(InstructionType.MOVE, name[4:], MOVE_PATTERN, SmaliInstruction.extract_move, 'move')
+
+    @staticmethod
+    def return_(name: str):
+        return Opcode(InstructionType.RETURN, name[6:], RETURN_PATTERN, SmaliInstruction.extract_return, 'return')
+
+    @staticmethod
+    def unknown(name: str):
+        return Opcode(InstructionType.UNKNOWN)
+
+    @staticmethod
+    def from_prefix(name: str) -> 'Opcode':
+        if name.startswith(('iget', 'iput', 'sget', 'sput')):
+            return Opcode.field_access(name)
+        elif name.startswith('invoke'):
+            return Opcode.method_invoke(name)
+        elif name.startswith('const'):
+            return Opcode.constant(name)
+        elif name.startswith('new-array'):
+            return Opcode.new_array(name)
+        elif name.startswith('new-instance'):
+            return Opcode.new_instance(name)
+        elif name.startswith(('goto', 'if-')):
+            return Opcode.branch(name)
+        elif name.startswith('move-result'):
+            return Opcode.move_result(name)
+        elif name.startswith('move'):
+            return Opcode.move(name)
+        elif name.startswith('return'):
+            return Opcode.return_(name)
+        return Opcode.unknown(name)
+
+def build_opcode_table():
+    field_types = ['', '-wide', '-object', '-boolean', '-byte', '-char', '-short']
+    arithmetic = ['add', 'sub', 'mul', 'div', 'rem', 'and', 'or', 'xor', 'shl', 'shr', 'ushr']
+    mnemonics = [
+        f'{access}{field_type}' for access in ['iget', 'iput', 'sget', 'sput'] for field_type in field_types
+    ] + [
+        f'invoke-{kind}{range_suffix}'
+        for kind in ['virtual', 'super', 'direct', 'static', 'interface', 'polymorphic', 'custom']
+        for range_suffix in ['', '/range']
+    ] + [
+        'const/4', 'const/16', 'const', 'const/high16',
+        'const-wide/16', 'const-wide/32', 'const-wide', 'const-wide/high16',
+        'const-string', 'const-string/jumbo', 'const-class', 'const-method-handle', 'const-method-type',
+        'new-array', 'new-instance',
+        'goto', 'goto/16', 'goto/32',
+    ] + [
+        f'if-{condition}{zero}' for condition in ['eq', 'ne', 'lt', 'ge', 'gt', 'le'] for zero in ['', 'z']
+    ] + [
+        'move-result', 'move-result-wide', 'move-result-object',
+        'move', 'move/from16', 'move/16',
+        'move-wide', 'move-wide/from16', 'move-wide/16',
+        'move-object', 'move-object/from16', 'move-object/16',
+        'move-exception',
+        'return-void', 'return', 'return-wide', 'return-object',
+        'nop', 'monitor-enter', 'monitor-exit', 'check-cast', 'instance-of', 'array-length',
+        'filled-new-array', 'filled-new-array/range', 'fill-array-data', 'throw',
+        'packed-switch', 'sparse-switch',
+        'cmpl-float', 'cmpg-float', 'cmpl-double', 'cmpg-double', 'cmp-long',
+        'neg-int', 'not-int', 'neg-long', 'not-long', 'neg-float', 'neg-double',
+        'int-to-long', 'int-to-float', 'int-to-double', 'long-to-int', 'long-to-float', 'long-to-double',
+        'float-to-int', 'float-to-long', 'float-to-double', 'double-to-int', 'double-to-long', 'double-to-float',
+        'int-to-byte', 'int-to-char', 'int-to-short',
+        'rsub-int', 'rsub-int/lit8',
+    ] + [
+        f'{array_access}{field_type}' for array_access in ['aget', 'aput'] for field_type in field_types
+    ] + [
+        f'{operation}-{value_type}{suffix}'
+        for operation in arithmetic
+        for value_type in ['int', 'long']
+        for suffix in ['', '/2addr']
+    ] + [
+        f'{operation}-{value_type}{suffix}'
+        for operation in ['add', 'sub', 'mul', 'div', 'rem']
+        for value_type in ['float', 'double']
+        for suffix in ['', '/2addr']
+    ] + [
+        f'{operation}-int/lit16' for operation in ['add', 'mul', 'div', 'rem', 'and', 'or', 'xor']
+    ] + [
+        f'{operation}-int/lit8' for operation in arithmetic
+    ] + [
+        '.line', '.param', '.end', '.local', '.restart', '.prologue', '.epilogue', '.registers',
+        '.catch', '.catchall', '.annotation', '.subannotation', '.source',
+        '.packed-switch', '.sparse-switch', '.array-data',
+    ]
+    return {name: Opcode.from_prefix(name) for name in mnemonics}
+
+OPCODES = build_opcode_table()
+
+def lookup_opcode(name: str) -> Opcode:
+    opcode = OPCODES.get(name)
+    if opcode is None:
+        opcode = OPCODES[name] = Opcode.from_prefix(name)
+    return opcode
+
+class SmaliField(SmaliPiece):
+    __slots__ = ('_line', 'parent', 'span', 'dirty', '_name', '_modifiers', '_type', '_value')
+
+    def __init__(self, line: str, parent: Any, parsed_field: Optional[tuple] = None):
+        self.parent = parent
+        self.span: Optional[tuple] = None
+        self.dirty = False
+        if parsed_field is None:
+            parsed_field = parse_field_line(line)
+        if parsed_field is not None:
+            name, field_type, modifiers, value = parsed_field
+            intern = parent.workspace.intern if isinstance(parent, SmaliClass) else intern_value
+            line, name, field_type = None, intern(name), intern(field_type)
+        else:
+            name = field_type = modifiers = value = None
+        self.name = name
+        self._line = line
+        self._type = field_type
+        self._modifiers = modifiers
+        self._value = value
+
+    line = tracked_field('_line')
+    modifiers = tracked_field('_modifiers')
+    type = tracked_field('_type')
+    value = tracked_field('_value')
+
+    @property
+    def name(self) -> Optional[str]:
+        return self._name
+
+    @name.setter
+    def name(self, value: Optional[str]):
+        old_name = getattr(self, '_name', None)
+        self._name = value
+        if old_name is not None and isinstance(self.parent, SmaliClass):
+            self.mark_dirty()
+            self.parent.member_renamed('field', self, old_name)
+
+    def mark_dirty(self):
+        self.dirty = True
+        if isinstance(self.parent, SmaliClass):
+            self.parent.dirty = True
+
+    @property
+    def descriptor(self) -> str:
+        return f"{self.name}:{self.type}"
+
+    @property
+    def details(self) -> FieldDetails:
+        return FieldDetails(
+            name = self.name,
+            modifiers = self.modifiers,
+            type = self.type,
+            value = self.value,
+        )
 
     def __str__(self):
+        if not self.dirty and self.span is not None:
+            return self.parent.source[self.span[0]:self.span[1]]
         if self.line:
             return self.line
-        value_str = f' = {self.details.value}' if isinstance(self.details.value, str) and len(self.details.value) > 0 else ''
-        modifiers_str = (' '.join(self.details.modifiers) if self.details.modifiers is not None else '') + (' ' if len(self.details.modifiers) > 0 else '')
-        return f'.field {modifiers_str}{self.details.name}:{self.details.type}{value_str}'
+        value_str = f' = {self.value}' if isinstance(self.value, str) and len(self.value) > 0 else ''
+        modifiers_str = (' '.join(self.modifiers) if self.modifiers is not None else '') + (' ' if len(self.modifiers) > 0 else '')
+        return f'.field {modifiers_str}{self.name}:{self.type}{value_str}'
 
 def replace_file(dst, perms = 0o644, owner = "root:root", secontext = "u:object_r:system_file:s0", src = None):
     logging.info(f"Replacing {dst}...")
@@ -0,0 +1,415 @@
+import os
+import random
+import tempfile
+import unittest
+
+from smali_patcher import *
+
+SOURCE = """.class public Lcom/example/Sample;
+.super Ljava/lang/Object;
+.source "Sample.java"
+
+
+# static fields
+.field private static count:I
+
+
+# direct methods
+.method public static run(I)V
+    .locals 2
+
+    if-eqz p0, :cond_0
+
+    const/4 v0, 0x1
+
+    :cond_0
+    return-void
+.end method
+"""
+
+SWITCH_SOURCE = """.class public Lcom/example/Switch;
+.super Ljava/lang/Object;
+
+.method public static pick(I)I
+    .locals 1
+
+    :try_start_0
+    packed-switch p0, :pswitch_data_0
+    :try_end_0
+    .catch Ljava/lang/Exception; {:try_start_0 .. :try_end_0} :catch_0
+
+    const/4 v0, 0x0
+    return v0
+
+    :pswitch_0
+    const/4 v0, 0x1
+    return v0
+
+    :pswitch_1
+    const/4 v0, 0x2
+    return v0
+
+    :catch_0
+    const/4 v0, -0x1
+    return v0
+
+    :pswitch_data_0
+    .packed-switch 0x0
+        :pswitch_0
+        :pswitch_1
+    .end packed-switch
+.end method
+"""
+
+RANGE_SOURCE = """.class public Lcom/example/Range;
+.super Ljava/lang/Object;
+
+.method public static mix(I)V
+    .locals 4
+
+    const/4 v0, 0x0
+    const/4 v1, 0x1
+    const/4 v2, 0x2
+    if-eqz p0, :cond_0
+    const/4 v3, 0x3
+    invoke-static {v3}, La;->g(I)V
+    :cond_0
+    invoke-static/range {v0 .. v2}, La;->f(III)V
+    return-void
+.end method
+"""
+
+def sample_method(smali_class: SmaliClass) -> SmaliMethod:
+    return smali_class.find_methods(MethodDetails(name = "run"))[0]
+
+PATCH_LINES = {
+    'const/4 v0, 0x1': InstructionType.CONSTANT,
+    'const/4 v1, 0x0': InstructionType.CONSTANT,
+    'invoke-static {v0}, La;->f(I)V': InstructionType.METHOD_INVOKE,
+    'iget v0, p0, La;->x:I': InstructionType.FIELD_READ,
+    'return-void': InstructionType.RETURN,
+    'if-eqz v0, :cond_0': InstructionType.BRANCH,
+    ':cond_0': InstructionType.LABEL,
+    'move v1, v0': InstructionType.MOVE,
+}
+PATCH_EDITS = {
+    'insert_before': lambda instruction, line: instruction.insert_before(line),
+    'insert_after': lambda instruction, line: instruction.insert_after(line),
+    'replace': lambda instruction, line: instruction.replace(line),
+    'remove': lambda instruction, line: instruction.remove(),
+    'expand': lambda instruction, line: instruction.expand_after([line, line]),
+}
+
+class SmaliInstructionTest(unittest.TestCase):
+    def test_field_written_before_read(self):
+        method = sample_method(SmaliClass(SOURCE))
+        branch, constant = method.instructions[1:3]
+        self.assertFalse(branch.decoded or constant.decoded)
+        branch.label = ':cond_1'
+        constant.constant_value = '0x0'
+        self.assertEqual(str(branch).strip(), 'if-eqz p0, :cond_1')
+        self.assertEqual(str(constant).strip(), 'const/4 v0, 0x0')
+
+    def test_register_filters_take_names(self):
+        method = sample_method(SmaliClass(SOURCE))
+        def matching_lines(registers, instruction_type = None):
+            lines = []
+            details = InstructionDetails(instruction_type = instruction_type, registers = registers)
+            method.for_instruction(details, lambda instruction: lines.append(instruction.original_line))
+            return lines
+        self.assertEqual(matching_lines(['v0']), ['const/4 v0, 0x1'])
+        self.assertEqual(matching_lines(Matcher.contains('p0'), InstructionType.BRANCH), ['if-eqz p0, :cond_0'])
+        self.assertEqual(matching_lines(Matcher.regex(r"\['v0'\]$")), ['const/4 v0, 0x1'])
+        self.assertEqual(matching_lines(Matcher.contains(Matcher.regex('p')), InstructionType.BRANCH), ['if-eqz p0, :cond_0'])
+        with self.assertRaises(ValueError):
+            InstructionDetails(registers = ['x0'])
+
+class ControlFlowGraphTest(unittest.TestCase):
+    def test_switch_and_catch_edges(self):
+        flow = SmaliClass(SWITCH_SOURCE).methods[0].get_flow()
+        def leaders(blocks):
+            return sorted(block.instructions[0].original_line for block in blocks)
+        switch = flow.block_of[flow.labels[':try_start_0']]
+        catch = flow.block_of[flow.labels[':catch_0']]
+        payload = flow.block_of[flow.labels[':pswitch_data_0']].successors[0]
+        self.assertEqual(switch.instructions[-1].operation, 'packed-switch')
+        self.assertEqual(leaders(switch.successors), [':pswitch_0', ':pswitch_1', ':try_end_0'])
+        self.assertEqual(switch.handlers, [catch])
+        self.assertEqual(catch.predecessors, [switch])
+        self.assertEqual(flow.block_of[flow.labels[':try_end_0']].handlers, [])
+        self.assertTrue(payload.is_payload)
+        self.assertEqual(payload.successors, [])
+
+class LivenessTest(unittest.TestCase):
+    def test_free_registers_across_range_and_branch(self):
+        method = SmaliClass(RANGE_SOURCE).methods[0]
+        def free_registers(line, n):
+            instruction = next(instruction for instruction in method.instructions if instruction.original_line == line)
+            return [str(register) for register in instruction.get_n_free_registers(n)]
+        self.assertEqual(free_registers('const/4 v1, 0x1', 2), ['v1', 'v2'])
+        self.assertEqual(free_registers('if-eqz p0, :cond_0', 1), ['v3'])
+        self.assertEqual(free_registers('invoke-static {v3}, La;->g(I)V', 1), ['v4'])
+        self.assertEqual(free_registers(':cond_0', 2), ['v3', 'v4'])
+        self.assertEqual(free_registers('return-void', 2), ['v0', 'v1'])
+        self.assertEqual(method.locals, 5)
+
+SEQUENCE_LINES = [
+    'const-string v0, "a"', 'const-string v1, "b"', 'invoke-static {v0}, La;->f(Ljava/lang/String;)I',
+    'invoke-static {v1, v0}, La;->g(Ljava/lang/String;Ljava/lang/String;)I', 'move-result v0', '.line 3', '', 'return-void',
+]
+
+class SequenceAutomatonTest(unittest.TestCase):
+    def test_matches_chained_next_known(self):
+        # The screen-off animation scale patch before it used a SequencePattern.
+        def chained_match(instruction):
+            if instruction.instruction_type != InstructionType.CONSTANT:
+                return None
+            invoke = instruction.next_known()
+            if invoke is None or invoke.instruction_type != InstructionType.METHOD_INVOKE \
+                    or len(invoke.registers) == 0 or invoke.registers[-1] != instruction.registers[0]:
+                return None
+            result = invoke.next_known()
+            if result is None or result.instruction_type != InstructionType.MOVE_RESULT:
+                return None
+            return [instruction, invoke, result]
+
+        automaton = SequencePattern([
+            SequenceStep(InstructionDetails(InstructionType.CONSTANT), bind = {'setting': 0}),
+            SequenceStep(InstructionDetails(InstructionType.METHOD_INVOKE), bind = {'setting': -1}),
+            InstructionDetails(InstructionType.MOVE_RESULT),
+        ]).compile()
+        for seed in range(1000):
+            rng = random.Random(seed)
+            body = ''.join(f'    {rng.choice(SEQUENCE_LINES)}\n' for _ in range(rng.randint(4, 16)))
+            method = SmaliClass(f'.class public La;\n.super Ljava/lang/Object;\n.method public f()V\n{body}.end method\n').methods[0]
+            expected = [match for match in map(chained_match, method.iterate_instructions()) if match is not None]
+            with self.subTest(seed = seed):
+                self.assertEqual([list(match) for match in automaton.find(method)], expected)
+
+class SmaliTemplateTest(unittest.TestCase):
+    def test_placeholders_are_substituted(self):
+        method = sample_method(SmaliClass(SOURCE))
+        template = SmaliTemplate([
+            'const-string {value}, "{key}"',
+            'invoke-static {{{value}, {flag}}}, {owner}->get(Ljava/lang/String;I)I',
+            'move-result {flag}',
+            'if-eqz {flag}, {done}',
+            'sget-object {value}, {owner}->CACHE:Ljava/lang/Object;',
+            '{done}',
+        ], labels = ['done'])
+        for values in (
+            {'value': 'v0', 'flag': 'v1', 'key': 'a', 'owner': 'La;'},
+            {'value': Register.v(1), 'flag': 'p0', 'key': 'b c', 'owner': 'Lb/C;', 'done': ':exit'},
+        ):
+            instructions = template.instantiate(method, **values)
+            label = instructions[-1].label
+            self.assertEqual(label, values.get('done', ':done_0'))
+            for line, instruction in zip(template.lines, instructions):
+                parsed = SmaliInstruction(line.format(**{**values, 'done': label}), method).decode()
+                self.assertEqual(str(instruction), str(parsed))
+                self.assertEqual(instruction.details, parsed.details)
+        self.assertEqual(len(template.compiled), 1)
+
+SYMBOL_SOURCE = b""".class public La;
+.super Ljava/lang/Object;
+
+.field private x:I
+
+.method public run(I)V
+    .locals 2
+    const-string v0, "Lb;->fake()V"
+    invoke-static {v0}, Lb;->f(Ljava/lang/String;)I
+    iget v1, p0, La;->x:I
+    sput v1, Lb;->count:I
+    return-void
+.end method
+
+.method private static g()V
+    .locals 0
+    invoke-virtual {p0}, Lb;->f(I)I # comment
+    return-void
+.end method
+"""
+
+class SymbolIndexTest(unittest.TestCase):
+    def test_find_references(self):
+        index = SymbolIndex()
+        index.add_file('a.smali', SYMBOL_SOURCE)
+        index.add_file('c.smali', b'.class public Lc;\n.super Ljava/lang/Object;\n.method public h()V\n    sget v0, Lb;->count:I\n.end method\n')
+        self.assertEqual(sorted(index.find('Lb;->f')), [('a.smali', 'g()V', 'invoke'), ('a.smali', 'run(I)V', 'invoke')])
+        self.assertEqual(index.find('Lb;->f(I)I'), [('a.smali', 'g()V', 'invoke')])
+        self.assertEqual(index.find('La;->x:I'), [('a.smali', 'run(I)V', 'read')])
+        self.assertEqual(index.find('Lb;->fake'), [])
+        self.assertEqual(index.files_invoking('Lb;->f'), ['a.smali'])
+        self.assertEqual(index.files_referencing('Lb;->count:I', 'write'), ['a.smali'])
+        self.assertEqual(sorted(index.files_referencing('Lb;->count')), ['a.smali', 'c.smali'])
+
+class InstructionPatchTest(unittest.TestCase):
+    def test_fused_walk_matches_sequential_walks(self):
+        for seed in range(500):
+            rng = random.Random(seed)
+            lines = list(PATCH_LINES)
+            body = ''.join(f'    {rng.choice(lines)}\n' for _ in range(rng.randint(1, 8)))
+            source = f'.class public La;\n.super Ljava/lang/Object;\n.method public f()V\n    .locals 2\n{body}.end method\n'
+            edits = []
+            for _ in range(rng.randint(2, 4)):
+                # A patch that adds lines it matches itself would never finish either way.
+                instruction_type = PATCH_LINES[rng.choice(lines)]
+                line = rng.choice([line for line in lines if PATCH_LINES[line] != instruction_type])
+                edits.append((instruction_type, rng.choice(list(PATCH_EDITS)), line))
+            outputs = []
+            for fused in (False, True):
+                smali_class = SmaliClass(source)
+                patches = [
+                    InstructionPatch(
+                        instruction = InstructionDetails(instruction_type = instruction_type),
+                        action = lambda instruction, edit = PATCH_EDITS[edit], line = line: edit(instruction, line),
+                    )
+                    for instruction_type, edit, line in edits
+                ]
+                if fused:
+                    smali_class.apply_instruction_patches(patches)
+                else:
+                    for patch in patches:
+                        smali_class.for_instruction(patch.instruction, patch.action)
+                outputs.append(str(smali_class))
+            with self.subTest(seed = seed, edits = edits):
+                self.assertEqual(outputs[0], outputs[1])
+
+class SmaliMemberTest(unittest.TestCase):
+    def test_lazy_member_edits_are_printed(self):
+        smali_class = SmaliClass(SOURCE)
+        method = sample_method(smali_class)
+        field = smali_class.fields[0]
+        self.assertIsNotNone(method.body_lines)
+        method.access_modifiers = ['private', 'static']
+        field.value = '0x2'
+        source = str(smali_class)
+        self.assertIn('.method private static run(I)V', source)
+        self.assertIn('.field private static count:I = 0x2', source)
+        self.assertIn('    if-eqz p0, :cond_0', source)
+        self.assertIsNotNone(method.body_lines)
+
+class FilePatchTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cwd = os.getcwd()
+        os.chdir(self.directory.name)
+        with open('Sample.smali', 'w') as f:
+            f.write(SOURCE)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.directory.cleanup()
+
+    def patched_source(self, file_patch: FilePatch) -> str:
+        workspace = Workspace([file_patch])
+        file_patch.apply(workspace)
+        workspace.write_back()
+        with open('Sample.smali') as f:
+            return f.read()
+
+    def test_file_action_edits_are_written(self):
+        def edit(smali_file):
+            method = sample_method(smali_file.smali_class)
+            method.locals = 3
+            method.instructions[2].constant_value = '0x0'
+        source = self.patched_source(FilePatch([r'Sample\.smali'], [InstructionPatch(action = edit)]))
+        self.assertIn('.locals 3', source)
+        self.assertIn('const/4 v0, 0x0', source)
+
+    def test_handles_and_diff_survive_edits(self):
+        def edit(smali_file):
+            method = sample_method(smali_file.smali_class)
+            branch, constant, label = method.instructions[1:4]
+            branch.insert_before('const/4 v1, 0x0')
+            self.assertEqual((branch.position, constant.position), (2, 3))
+            self.assertIs(constant.remove(), label)
+            self.assertIsNone(constant.position)
+            self.assertIs(branch.next, label)
+            smali_file.smali_class.fields[0].value = '0x1'
+        workspace = Workspace()
+        FilePatch([r'Sample\.smali'], [InstructionPatch(action = edit)]).apply(workspace)
+        workspace.write_back()
+        with open('Sample.smali') as f:
+            source = f.read()
+        def changed_lines(lines):
+            return sorted(line for line in lines if line[:1] in '+-' and line[:3] not in ('---', '+++'))
+        self.assertEqual(
+            changed_lines(workspace.diffs.lines()),
+            changed_lines(compare_changes(SOURCE.splitlines(), source.splitlines())),
+        )
+        self.assertIn('+    const/4 v1, 0x0', workspace.diffs.lines())
+
+    def test_standalone_apply_writes_file_and_diff(self):
+        def edit(smali_file):
+            sample_method(smali_file.smali_class).locals = 4
+        FilePatch([r'Sample\.smali'], [InstructionPatch(action = edit)]).apply()
+        with open('Sample.smali') as f:
+            self.assertIn('.locals 4', f.read())
+        with open('Sample.diff') as f:
+            self.assertIn('+    .locals 4', f.read())
+
+    def test_expected_count_checked_on_skipped_file(self):
+        file_patch = FilePatch([r'Sample\.smali'], [
+            InstructionPatch(
+                instruction = InstructionDetails(method = "renamedMethod"),
+                action = lambda instruction: None,
+                expected_count = 1,
+            ),
+        ])
+        with self.assertRaises(PatchCountError):
+            file_patch.apply(Workspace([file_patch]))
+
+    def test_file_counts_checked_past_limit(self):
+        with open('Sample2.smali', 'w') as f:
+            f.write(SOURCE.replace('Lcom/example/Sample;', 'Lcom/example/Sample2;'))
+        def edit(smali_file):
+            sample_method(smali_file.smali_class).locals = 3
+        for counts in ({'expected_count': 1}, {'max_count': 1}, {'expected_count': 3}):
+            file_patch = FilePatch([r'Sample2?\.smali'], [InstructionPatch(action = edit)], **counts)
+            with self.assertRaises(PatchCountError):
+                file_patch.apply(Workspace([file_patch]))
+        file_patch = FilePatch([r'Sample2?\.smali'], [InstructionPatch(action = edit)], expected_count = 2, max_count = 2)
+        self.assertEqual(sorted(build_patch_tasks([file_patch], Workspace([file_patch]))), [['./Sample.smali'], ['./Sample2.smali']])
+        file_patch.apply(Workspace([file_patch]))
+
+    def test_file_patterns_with_groups(self):
+        for name in ('axa.smali', 'axb.smali', 'bb.smali', 'ba.smali', 'Upper.smali'):
+            open(name, 'w').close()
+        backreferences = FilePatch([r'(a)x\1\.smali', r'(b)\1\.smali'], [])
+        flags = FilePatch([r'(?i)upper\.smali'], [])
+        plain = FilePatch([r'Sample\.smali'], [])
+        def names(index, file_patch):
+            return sorted(os.path.basename(path) for path in index.files_for(file_patch))
+        index = FileIndex([backreferences, plain])
+        self.assertEqual(names(index, backreferences), ['axa.smali', 'bb.smali'])
+        self.assertEqual(names(index, plain), ['Sample.smali'])
+        index = FileIndex([flags, plain])
+        self.assertEqual(names(index, flags), ['Upper.smali'])
+        self.assertEqual(names(index, plain), ['Sample.smali'])
+
+    def test_class_selectors(self):
+        classes = [
+            ('Base', 'Ljava/lang/Object;', '', ['Lcom/example/Listener;']),
+            ('Child', 'Lcom/example/Base;', '', []),
+            ('Other', 'Ljava/lang/Object;', '', []),
+            ('Listener', 'Ljava/lang/Object;', 'interface abstract ', ['Lcom/example/Callback;']),
+        ]
+        for name, superclass, modifiers, interfaces in classes:
+            with open(f'{name}.smali', 'w') as f:
+                f.write(f'.class public {modifiers}Lcom/example/{name};\n.super {superclass}\n')
+                f.writelines(f'.implements {interface}\n' for interface in interfaces)
+        index = FileIndex([])
+        subclasses = FilePatch([], [], subclasses_of = ['Ljava/lang/Object;'])
+        implementors = FilePatch([], [], implementors_of = ['Lcom/example/Callback;'])
+        narrowed = FilePatch([r'Child\.smali'], [], implementors_of = ['Lcom/example/Callback;'])
+        self.assertEqual(
+            sorted(os.path.basename(path) for path in index.files_for(subclasses)),
+            ['Base.smali', 'Child.smali', 'Listener.smali', 'Other.smali', 'Sample.smali'],
+        )
+        self.assertEqual(sorted(os.path.basename(path) for path in index.files_for(implementors)), ['Base.smali', 'Child.smali'])
+        self.assertEqual([os.path.basename(path) for path in index.files_for(narrowed)], ['Child.smali'])
+
+if __name__ == '__main__':
+    unittest.main()